@@ -0,0 +1,149 @@
+import os, time, json, base64, hashlib
+
+from . import core
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class CheckpointError(Exception): pass
+
+class StateCheckpoint:
+	'''Daemon state snapshot, stored in a directory as "state.json" file, with raw
+			image data from notification hints in separate "img.<hash>" files, so that
+			each image is only written once, keeping state file small and quick to update.
+		All files are replaced atomically via rename, so checkpoint is either
+			old or new one on crash, and images not referenced anymore get removed after that.
+		History entries don't change after being added, so these are only serialized
+			once, and state file is put together from cached json on every save().
+		Notification timestamps are stored as wall-clock time, and converted
+			to/from "clock" values (same as Notification.created) on save/load.'''
+
+	version = 1
+	image_hints = core.image_data_hints
+
+	def __init__(self, path, clock=time.monotonic):
+		self.path, self.clock = path, clock
+		self._images, self._images_used = set(), set() # stored / referenced by last save()
+		os.makedirs(path, 0o700, exist_ok=True)
+
+	def _ts_dump(self, ts):
+		return ts if ts is None else time.time() - (self.clock() - ts)
+
+	def _ts_load(self, ts):
+		return ts if ts is None else self.clock() - (time.time() - ts)
+
+	def _plain(self, data):
+		# Same as PubSub.strip_dbus_types, as json can't handle dbus types
+		# Byte arrays are stored as {"$b64": ...} objects, and restored as bytes on load
+		if isinstance(data, dict): return dict((self._plain(k), self._plain(v)) for k, v in data.items())
+		elif isinstance(data, (list, tuple)): return list(map(self._plain, data))
+		elif isinstance(data, (bytes, bytearray)): return {'$b64': base64.b64encode(data).decode()}
+		elif data is None: return data
+		for t in bool, int, float, str:
+			if isinstance(data, t): return t(data)
+		raise CheckpointError(f'Failed to serialize value of type {type(data)}: {data!r}')
+
+	def _image_dump(self, image):
+		data = core.image_data_bytes(image[-1])
+		digest = hashlib.blake2b(data, digest_size=16).hexdigest()
+		if digest not in self._images:
+			self._write(f'img.{digest}', data)
+			self._images.add(digest)
+		self._images_used.add(digest)
+		return digest
+
+	def _image_load(self, digest, cache):
+		if (data := cache.get(digest)) is None:
+			with open(os.path.join(self.path, f'img.{digest}'), 'rb') as src: data = src.read()
+			cache[digest] = data
+			self._images.add(digest)
+		self._images_used.add(digest)
+		return data
+
+	def note_dump(self, note):
+		'Returns json-serializable dict for Notification object, storing its image data.'
+		if (images := getattr(note, 'checkpoint_images', None)) is None:
+			images = note.checkpoint_images = dict( (k, self._image_dump(note.hints[k]))
+				for k in self.image_hints if k in note.hints )
+		else: self._images_used.update(images.values()) # written in earlier save()
+		hints = dict((k, v) for k, v in note.hints.items() if k not in images)
+		data = dict(note.data, hints=hints)
+		rec = dict( data=self._plain(data), images=dict( (k, [self._plain(
+			list(note.hints[k])[:-1]), digest]) for k, digest in images.items() ) )
+		for k in 'id', 'repeat':
+			if (v := getattr(note, k, None)) is not None: rec[k] = v
+		rec['created'] = self._ts_dump(note.created)
+		if ts := getattr(note, 'display_time', None): rec['display_time'] = self._ts_dump(ts)
+		if ts := getattr(note, 'repeat_ts', None): rec['repeat_ts'] = list(map(self._ts_dump, ts))
+		return rec
+
+	def note_load(self, rec, image_cache):
+		data = rec['data']
+		if isinstance(data.get('plain'), list): data['plain'] = tuple(data['plain'])
+		for k, (image, digest) in rec.get('images', dict()).items():
+			data['hints'][k] = (*image, self._image_load(digest, image_cache))
+		note = core.Notification(**data)
+		note.created = self._ts_load(rec['created'])
+		for k in 'id', 'repeat':
+			if k in rec: setattr(note, k, rec[k])
+		if 'display_time' in rec: note.display_time = self._ts_load(rec['display_time'])
+		if 'repeat_ts' in rec: note.repeat_ts = tuple(map(self._ts_load, rec['repeat_ts']))
+		note.checkpoint_images = dict((k, digest) for k, (image, digest) in rec.get('images', dict()).items())
+		return note
+
+	def note_json(self, note):
+		'Same as note_dump(), but returns json, cached in the object, for ones that never change.'
+		if (rec := getattr(note, 'checkpoint_json', None)) is None:
+			rec = note.checkpoint_json = json.dumps(self.note_dump(note), separators=(',', ':'))
+		else: self._images_used.update(note.checkpoint_images.values())
+		return rec
+
+	def _write(self, name, data):
+		path = os.path.join(self.path, name)
+		try:
+			with open(f'{path}.tmp', 'wb') as dst:
+				dst.write(data)
+				dst.flush()
+				os.fsync(dst.fileno())
+			os.replace(f'{path}.tmp', path)
+		except OSError as err: raise CheckpointError(f'Failed to write {path!r}: {err}') from err
+
+	def save(self, state):
+		'''Atomically replace checkpoint with state dict,
+				where "history" and "buffer" keys are lists of Notification objects,
+				and all other values must be json-serializable.
+			Notifications in "history" must not be changed after being passed here.
+			Returns state file size, with any image data not included in it.'''
+		self._images_used.clear()
+		history = ','.join(map(self.note_json, state.get('history') or list()))
+		state = dict( state, version=self.version, ts=time.time(),
+			buffer=list(map(self.note_dump, state.get('buffer') or list())) )
+		state.pop('history', None)
+		data = json.dumps(state, separators=(',', ':'))
+		data = f'{data[:-1]},"history":[{history}]}}'.encode()
+		self._write('state.json', data)
+		for name in os.listdir(self.path): # cleanup
+			if not name.startswith('img.') or name[4:] in self._images_used: continue
+			self._images.discard(name[4:])
+			try: os.unlink(os.path.join(self.path, name))
+			except OSError: pass
+		return len(data)
+
+	def load(self):
+		'''Returns state dict from the last save() call, with "age" key
+			for seconds since then, or None if there is no usable checkpoint.'''
+		try:
+			with open(os.path.join(self.path, 'state.json'), 'rb') as src:
+				state = json.loads(src.read(), object_hook=lambda v: base64.b64decode(v['$b64'])
+					if len(v) == 1 and isinstance(v.get('$b64'), str) else v)
+			if state.get('version') != self.version: raise ValueError(f'version mismatch: {state.get("version")}')
+			image_cache = dict()
+			for k in 'history', 'buffer':
+				state[k] = list(self.note_load(rec, image_cache) for rec in state.get(k) or list())
+		except FileNotFoundError: return
+		except (OSError, ValueError, TypeError, KeyError) as err:
+			log.warning('Failed to load state checkpoint, ignoring it (%r): %s', self.path, err)
+			return
+		state['age'] = max(0, time.time() - state['ts'])
+		return state
@@ -1,8 +1,9 @@
 import operator as op, functools as ft, collections as cs
-import dbus, argparse, re, logging, time
+import dbus, argparse, os, re, logging, time
 
-from .scheme import load, init_env
-from .rate_control import FC_TokenBucket, RRQ
+from .scheme import load, init_env, is_literal_str, Profile, Env, Sym
+from . import scheme
+from .rate_control import FC_TokenBucket, FC_TokenBucketTree, FC_GCRA, FC_SlidingLog, RRQ, PRQ
 from . import __version__
 
 
@@ -47,6 +48,12 @@ def format_trunc(v, proc=to_str, len_max=None):
 def repr_trunc(v, len_max=None):
 	return format_trunc(v, proc=repr, len_max=len_max)
 
+def image_data_bytes(data):
+	'Returns bytes for "ay" part of image-data hint, without copying it, if possible.'
+	# dbus.ByteArray and bytes from pubsub/checkpoint are already bytes,
+	#  while dbus.Array of dbus.Byte can come from other dbus-python code
+	return data if isinstance(data, bytes) else bytes(data)
+
 def repr_trunc_rec(v, len_max=None, len_max_val=None, level=1):
 	# Formats all dict values as strings with quotes - it's fine, not worth the trouble fixing
 	if level == 0: return format_trunc(v)
@@ -60,17 +67,64 @@ def repr_trunc_rec(v, len_max=None, len_max_val=None, level=1):
 	return repr_trunc(v, len_max=len_max)
 
 
+class LRUCache(cs.OrderedDict):
+	'''Mapping of limited size, dropping least-recently-used keys, with hit/miss counters.
+		Size is a max number of keys, or max sum of weigh(value) for all values, if specified.'''
+
+	hits = misses = weight = 0
+
+	def __init__(self, size, weigh=None):
+		self.size, self.weigh = size, weigh
+		super().__init__()
+
+	def get(self, k, default=None):
+		try: v = self[k]
+		except KeyError:
+			self.misses += 1
+			return default
+		self.move_to_end(k)
+		self.hits += 1
+		return v
+
+	def __setitem__(self, k, v):
+		if self.weigh:
+			if k in self: self.weight -= self.weigh(super().__getitem__(k))
+			self.weight += self.weigh(v)
+		super().__setitem__(k, v)
+		self.move_to_end(k)
+		while self and (self.weight if self.weigh else len(self)) > self.size:
+			k, v = self.popitem(last=False)
+			if self.weigh: self.weight -= self.weigh(v)
+
+	def clear(self):
+		super().clear()
+		self.weight = 0
+
+	def stats(self):
+		stats = dict(hits=self.hits, misses=self.misses, size=len(self))
+		if not self.weigh: stats['size_max'] = self.size
+		else: stats.update(weight=self.weight, weight_max=self.size)
+		return stats
+
+
 ####
 
 optz = dict(
 	activity_timeout=10*60, popup_timeout=5,
-	queue_len=10, history_len=200, feed_icon=None,
-	tbf_size=4, tbf_tick=15, tbf_max_delay=60, tbf_inc=2, tbf_dec=2 )
+	queue_len=10, history_len=200, feed_icon=None, filter_cache=0,
+	tbf_size=4, tbf_tick=15, tbf_max_delay=60, tbf_inc=2, tbf_dec=2,
+	tbf_policy='token-bucket', tbf_source_max=1000, tbf_source_share=0.5 )
 poll_interval = 60
 
 urgency_levels = Enum('low', 'normal', 'critical')
 close_reasons = Enum('expired', 'dismissed', 'closed', 'undefined', vals=range(1, 5))
 
+flow_control_policies = {
+	'token-bucket': FC_TokenBucket, 'gcra': FC_GCRA, 'sliding-log': FC_SlidingLog }
+
+# Hints with raw (iiibiiay) image data, with "ay" received as bytes via dbus byte_arrays=True
+image_data_hints = 'image-data', 'image_data', 'icon_data'
+
 layout_anchor = Enum('top_left', 'top_right', 'bottom_left', 'bottom_right')
 layout_direction = Enum('horizontal', 'vertical')
 
@@ -130,33 +184,164 @@ class Notification(cs.UserDict):
 NotificationMessage = cs.namedtuple('NotificationMessage', 'hostname ts note')
 
 
-_scheme_state = None
+class RegexSet:
+	'''Set of regexps to match against string in one pass, via single alternation regexp.
+		Match returns the pattern matched earliest in the string (first listed one,
+			if several match at the same position), falling back to trying them one-by-one
+			if patterns cannot be combined, e.g. due to numbered backrefs or global flags.
+		Combined regexp has no capturing groups, as these disable re prefix/charset
+			optimizations, so which pattern matched is only checked at the match position.'''
+
+	def __init__(self, patterns):
+		self.patterns = list(patterns)
+		self.regex_list, self.regex = list(map(re.compile, self.patterns)), None
+		if not any(re.search(r'\\\d|\(\?P=', p) for p in self.patterns):
+			try: self.regex = re.compile('|'.join(f'(?:{p})' for p in self.patterns))
+			except re.error: pass
+
+	def search(self, string):
+		if self.regex:
+			if not (m := self.regex.search(string)): return
+			pos, check = m.start(), lambda regex: regex.match(string, pos)
+		else: check = lambda regex: regex.search(string)
+		for p, regex in zip(self.patterns, self.regex_list):
+			if check(regex): return p
 
-def get_filter(path, sound_env=None):
-	global _scheme_state
-	if _scheme_state is None:
+	def __repr__(self):
+		return f'<RegexSet[{id(self):x}] {len(self.patterns)} pattern(s)>'
+
+def re_search(regex, string):
+	if not isinstance(regex, re.Pattern): regex = re.compile(regex)
+	return bool(regex.search(string))
+
+@ft.lru_cache(maxsize=64)
+def _re_set(patterns): return RegexSet(patterns)
+
+def re_search_set(string, *patterns):
+	if len(patterns) == 1 and isinstance(patterns[0], RegexSet): regex_set = patterns[0]
+	else: regex_set = _re_set(patterns)
+	return regex_set.search(string) or False
+
+def re_search_hook(args):
+	'Pre-compiles literal regexp in (~ regex string) calls on filter load.'
+	if len(args) == 2 and is_literal_str(args[0]): args = [re.compile(args[0]), args[1]]
+	return args
+
+def re_search_set_hook(args):
+	'Pre-compiles all-literal (~match string regex ...) patterns into RegexSet on filter load.'
+	if len(args) > 1 and all(map(is_literal_str, args[1:])): args = [args[0], RegexSet(args[1:])]
+	return args
+
+
+_scheme_init = False
+
+# Builtins with side-effects, filters using these can't have results cached
+filter_impure_builtins = {'sound-play', 'sound-cache', 'sound-play-sync', 'debug', 'eval'}
+
+def filter_props_apply(note, props):
+	for k, v in zip(*([iter(props)]*2)):
+		if not k.startswith('hints.'): note[k] = v
+		else: note.setdefault('hints', dict())[k[6:]] = v
+
+def get_filter( path, sound_env=None,
+		compiled=True, cache_size=0, profile=False, parse_cache_dir=None ):
+	'''Returns filter function, loaded from specified path.
+		Each filter file is loaded into its own namespace and has its own props state,
+			so that any number of these can be used at the same time.
+		cache_size enables LRU cache of results and props set from filter
+			(keyed by summary, body and app_name) for filters that are not using impure builtins,
+			and do not change global or closure variables from procedures via (set ...).
+		"cache" attribute of returned function is LRUCache object or None, if not used.
+		profile=True enables collecting scheme.Profile stats into "profile" attribute.
+		parse_cache_dir enables caching of parsed/expanded filter code in that dir.'''
+	global _scheme_init
+	if not _scheme_init:
 		sound_env = sound_env or dict()
 		noop_func = lambda *a: None
 		init_env({
-			'~': lambda regex, string: bool(re.search(regex, string)),
+			'~': re_search, '~match': re_search_set,
 			'sound-play': sound_env.get('play', noop_func),
 			'sound-cache': sound_env.get('cache', noop_func),
-			'sound-play-sync': sound_env.get('play_sync', noop_func),
-			'props': lambda *props: _scheme_state.update(props=props) })
-		_scheme_state = dict()
-	scheme_func = load(path)
+			'sound-play-sync': sound_env.get('play_sync', noop_func) },
+			{'~': re_search_hook, '~match': re_search_set_hook})
+		_scheme_init = True
+	state, env = dict(), Env(outer=scheme.global_env)
+	env[Sym('props')] = lambda *props: state.update(props=props)
+	refs, sets, profile = set(), set(), Profile() if profile else None
+	scheme_func = load( path, compiled=compiled, refs=refs, sets=sets,
+		profile=profile, cache_dir=parse_cache_dir, env=env )
+	cache = None
+	if cache_size > 0:
+		log = logging.getLogger('core.filter')
+		if impure := filter_impure_builtins.intersection(refs):
+			log.debug( 'Not using filter results cache,'
+				' due to impure builtins used: %s', ', '.join(sorted(impure)) )
+		elif sets:
+			log.debug( 'Not using filter results cache, due to'
+				' non-local variables set in procedures: %s', ', '.join(sorted(sets)) )
+		else: cache = LRUCache(cache_size)
 	def filter_func(summary, body, note=None):
-		_scheme_state.clear()
+		if cache is not None:
+			cache_key = summary, body, note.get('app_name') if note is not None else None
+			if res := cache.get(cache_key):
+				result, props = res
+				if note is not None and props: filter_props_apply(note, props)
+				return result
+		state.clear()
 		result = scheme_func(summary, body)
-		if note is not None and (props := _scheme_state.get('props')):
-			for k, v in zip(*([iter(props)]*2)):
-				if not k.startswith('hints.'): note[k] = v
-				else: note.setdefault('hints', dict())[k[6:]] = v
+		props = state.get('props')
+		if cache is not None: cache[cache_key] = result, props
+		if note is not None and props: filter_props_apply(note, props)
 		return result
+	filter_func.cache, filter_func.profile = cache, profile
 	return filter_func
 
+
+class FilterIndex:
+	'''Set of filter functions, keyed by (key, name) tuples, where key is one of
+			"host" (x-nt-from-remote hint), "app" (app_name) or "category" (hint).
+		Notifications are dispatched to the first one matching these, in that order,
+			via dict lookups, falling back to default filter, or passing it, if that is None.'''
+
+	keys = 'host', 'app', 'category'
+
+	def __init__(self, default=None, filters=None):
+		self.default, self.filters = default, filters or dict()
+
+	def __bool__(self): return bool(self.default or self.filters)
+
+	def items(self):
+		'Returns list of (name, func) tuples for all filters, with "default" one first.'
+		return ( ([('default', self.default)] if self.default else list())
+			+ list((f'{k}.{name}', func) for (k, name), func in sorted(self.filters.items())) )
+
+	def get(self, note=None):
+		if not self.filters or note is None: return self.default
+		hints = note.get('hints') or dict()
+		for k, name in [('host', hints.get('x-nt-from-remote')), ('app', note.get('app_name'))]:
+			if name and (func := self.filters.get((k, str(name)))): return func
+		for name in str(hints.get('category') or '').split(','):
+			if name and (func := self.filters.get(('category', name.strip()))): return func
+		return self.default
+
+	def __call__(self, summary, body, note=None):
+		func = self.get(note)
+		return True if func is None else func(summary, body, note)
+
+def get_filter_index(path, dir_path=None, **filter_kws):
+	'''Returns FilterIndex with default filter loaded from path (if it exists) and
+		per-key ones from "<key>.<name>" files in dir_path (e.g. "app.firefox"), if specified.'''
+	default = get_filter(path, **filter_kws) if os.path.exists(path) else None
+	filters = dict()
+	if dir_path and os.path.isdir(dir_path):
+		for fn in sorted(os.listdir(dir_path)):
+			k, _, name = fn.partition('.')
+			if k not in FilterIndex.keys or not name: continue
+			filters[k, name] = get_filter(os.path.join(dir_path, fn), **filter_kws)
+	return FilterIndex(default, filters)
+
 def get_sound_env(force_sync=False, trap_errors=False):
-	assert _scheme_state is None # must be initialized before scheme env
+	assert not _scheme_init # must be initialized before scheme env
 	# Can pass window position and allow configuration of canberra props here
 	from .sounds import NotificationSounds, NSoundError, NSoundInitError
 	log = logging.getLogger('core.sound')
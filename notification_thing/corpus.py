@@ -0,0 +1,84 @@
+import os, sys, re, json, ast, time, collections as cs
+
+from . import core
+
+
+class CorpusError(Exception): pass
+
+# Daemon state change in a trace, e.g. ts=..., name="plug", value=True
+TraceEvent = cs.namedtuple('TraceEvent', 'ts name value')
+
+class NotificationCorpus:
+	'''Reader for files with recorded notifications, in any of the supported formats:
+			- JSON lines: objects with Notification fields (plus optional "ts" and "hostname"),
+				or lists of [hostname, ts, note_fields], as sent over pubsub.
+			- "notify-net-dump --json" output - same lists as above, in version-prefixed
+				and possibly repr-encoded (b'...') pubsub wire format.
+			- FileLogger (--log-file) logs.
+		Format is detected for each line, so these can be mixed.
+		Iterating over it yields core.NotificationMessage tuples, in file order.
+		With events=True, TraceEvent tuples are also yielded for JSON objects with
+			"ts" and one of the trace_events keys (e.g. {"ts": 123, "plug": true}),
+			which are skipped otherwise.'''
+
+	trace_events = 'plug', 'fullscreen'
+
+	log_line = re.compile(
+		r'^(?P<ts>\d{4}-\d\d-\d\d \d\d:\d\d:\d\d) :: (?P<uid>\S+) (?P<urgency>.) :: (?:-- |   )(?P<line>.*)$' )
+	log_urgency = {'!': core.urgency_levels.critical, '.': core.urgency_levels.low}
+
+	def __init__(self, src, events=False):
+		'src can be a path, "-" for stdin or a file-like object.'
+		self.src, self.events = src, events
+
+	def __iter__(self):
+		if self.src == '-': return self._parse(sys.stdin)
+		elif not isinstance(self.src, str): return self._parse(self.src)
+		return self._parse_path(self.src)
+
+	def _parse_path(self, path):
+		with open(os.path.expanduser(path)) as src: yield from self._parse(src)
+
+	def _parse(self, src):
+		log_note = None # FileLogger msgs span multiple lines
+		for n, line in enumerate(src, 1):
+			if not line.strip(): continue
+			if m := self.log_line.search(line.rstrip('\n')):
+				ts, uid, urgency, line = m.groups()
+				if log_note and log_note[0] == uid:
+					log_note[1].append(line)
+					continue
+				if log_note: yield self._log_msg(*log_note)
+				log_note = uid, [line], ts, urgency
+				continue
+			if log_note:
+				yield self._log_msg(*log_note)
+				log_note = None
+			try: msg = self._json_msg(line.strip())
+			except (ValueError, TypeError, SyntaxError) as err:
+				raise CorpusError(f'Failed to parse line {n}: {err}') from None
+			if self.events or not isinstance(msg, TraceEvent): yield msg
+		if log_note: yield self._log_msg(*log_note)
+
+	def _log_msg(self, uid, lines, ts, urgency):
+		ts = time.mktime(time.strptime(ts, '%Y-%m-%d %H:%M:%S'))
+		note = core.Notification(lines[0], '\n'.join(lines[1:]), hints=dict())
+		note.plain = note.summary, note.body # log has text with markup already stripped
+		urgency = self.log_urgency.get(urgency)
+		if urgency is not None: note.hints['urgency'] = urgency
+		return core.NotificationMessage(None, ts, note)
+
+	def _json_msg(self, line):
+		if line[:2] in ('b"', "b'"): line = ast.literal_eval(line).decode()
+		if line[0] not in '[{': line = line[1:] # pubsub protocol version
+		data = json.loads(line)
+		if isinstance(data, list): hostname, ts, data = data
+		else:
+			hostname, ts = data.pop('hostname', None), data.pop('ts', None)
+			if len(data) == 1 and (k := next(iter(data))) in self.trace_events:
+				return TraceEvent(ts, k, bool(data[k]))
+		if not isinstance(data, dict): raise ValueError(f'Unrecognized message data: {data!r}')
+		data = dict((k, v) for k, v in data.items() if k in core.Notification.init_args)
+		if isinstance(data.get('plain'), list): data['plain'] = tuple(data['plain'])
+		data['hints'] = dict(data.get('hints') or dict())
+		return core.NotificationMessage(hostname, ts, core.Notification(**data))
@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 
 import collections as cs, itertools as it, operator as op, functools as ft
-import os, sys, traceback, math, time
+import os, sys, traceback, hashlib, math, time
 
 from dbus.mainloop.glib import DBusGMainLoop
 import dbus, dbus.service
@@ -9,13 +9,13 @@ import dbus, dbus.service
 import gi
 gi.require_version('Gtk', '3.0')
 gi.require_version('Gdk', '3.0')
-try: from gi.repository import GLib, Gdk
+try: from gi.repository import GLib, Gdk, Gio
 except RuntimeError as err: # less verbose errors in case X isn't running
 	print(f'Gdk init error, exiting: {err.message}', file=sys.stderr)
 	sys.exit(1)
 
 
-if __name__ == '__main__':
+if not __package__: # script, or its import as __mp_main__ in filter worker processes
 	# Try to import submodules from the same path, not the site-packages
 	from os.path import join, realpath, dirname
 	module_root = realpath(dirname(dirname(__file__)))
@@ -23,12 +23,22 @@ if __name__ == '__main__':
 	from notification_thing.display import NotificationDisplay, strip_markup
 	from notification_thing.pubsub import PubSub
 	from notification_thing.file_logger import FileLogger
+	from notification_thing.filter_workers import FilterWorkers
+	from notification_thing.scheduler import Scheduler, VirtualScheduler
+	from notification_thing.spool import NotificationSpool, SpoolError
+	from notification_thing.checkpoint import StateCheckpoint, CheckpointError
+	from notification_thing.corpus import NotificationCorpus, CorpusError, TraceEvent
 	from notification_thing import core
 
 else:
-	from .display import NotificationDisplay
+	from .display import NotificationDisplay, strip_markup
 	from .pubsub import PubSub
 	from .file_logger import FileLogger
+	from .filter_workers import FilterWorkers
+	from .scheduler import Scheduler, VirtualScheduler
+	from .spool import NotificationSpool, SpoolError
+	from .checkpoint import StateCheckpoint, CheckpointError
+	from .corpus import NotificationCorpus, CorpusError, TraceEvent
 	from . import core
 
 optz, poll_interval, close_reasons, urgency_levels =\
@@ -74,6 +84,76 @@ def ts_diff_format( seconds, add_ago=False,
 		if add_ago: res.append('ago')
 		return ' '.join(res)
 
+def filter_bench(path, summary, body, count):
+	'Run filter from path on same message in interpreted and compiled modes, printing timings.'
+	res = dict()
+	for mode, compiled in ('eval', False), ('compiled', True):
+		func = core.get_filter(path, compiled=compiled)
+		ts = time.perf_counter()
+		for n in range(count): verdict = func(summary, body, note=dict())
+		res[mode] = ts = time.perf_counter() - ts
+		print( f'{mode}: {count} runs in {ts:.3f}s,'
+			f' {ts / count * 1e6:.1f}us per message, result: {verdict}' )
+	print('Speedup: x{:.2f}'.format(res['eval'] / res['compiled']))
+
+def icon_bench(w, h, count):
+	'''Unpack WxH RGBA image-data struct from dbus message and create pixbuf
+		from it, both as dbus.Array of dbus.Byte (copied into bytes for
+		Pixbuf.new_from_data) and as bytes via byte_arrays=True, printing timings.'''
+	import dbus.lowlevel
+	from gi.repository import GdkPixbuf
+	msg = dbus.lowlevel.SignalMessage('/', 'org.freedesktop.Notifications', 'IconBench')
+	msg.append((w, h, w * 4, True, 8, 4, os.urandom(w * h * 4)), signature='(iiibiiay)')
+	res = dict()
+	for mode, byte_arrays in ('dbus.Array', False), ('bytes', True):
+		ts = time.perf_counter()
+		for n in range(count):
+			w, h, rowstride, has_alpha, bps, channels, data = msg.get_args_list(byte_arrays=byte_arrays)[0]
+			args = GdkPixbuf.Colorspace.RGB, bool(has_alpha), int(bps), int(w), int(h), int(rowstride)
+			if not byte_arrays:
+				data = bytes(bytearray(data))
+				pixbuf = GdkPixbuf.Pixbuf.new_from_data(data, *args)
+			else: pixbuf = GdkPixbuf.Pixbuf.new_from_bytes(GLib.Bytes.new(core.image_data_bytes(data)), *args)
+		res[mode] = ts = time.perf_counter() - ts
+		print( f'{mode}: {count} {w}x{h} icons in {ts:.3f}s,'
+			f' {ts / count * 1e3:.2f}ms per icon, pixbuf: {pixbuf.get_width()}x{pixbuf.get_height()}' )
+	print('Speedup: x{:.2f}'.format(res['dbus.Array'] / res['bytes']))
+
+def filter_corpus(path, corpus, dir_path=None, verbose=True, markup=True, **filter_kws):
+	'''Run all messages from NotificationCorpus through the filter (FilterIndex),
+		printing verdicts and props for each, and aggregate timing stats at the end.'''
+	func = core.get_filter_index(path, dir_path, **filter_kws)
+	n_pass, td_list = 0, list()
+	try:
+		for msg in corpus:
+			note = msg.note
+			if msg.hostname: note.hints.setdefault('x-nt-from-remote', msg.hostname)
+			if note.get('plain'): summary, body = note.plain
+			elif not note.hints.get('x-nt-markup', markup): summary, body = note.summary, note.body
+			else: summary, body = map(strip_markup, [note.summary, note.body])
+			data, ts = dict(note.data, hints=dict(note.hints)), time.perf_counter()
+			verdict = func(summary, body, note)
+			td_list.append(time.perf_counter() - ts)
+			if verdict: n_pass += 1
+			if not verbose: continue
+			props = dict((k, v) for k, v in note.data.items() if k != 'hints' and data.get(k) != v)
+			if hints := dict((k, v) for k, v in note.hints.items() if data['hints'].get(k) != v):
+				props['hints'] = hints
+			print('{} :: {}{!r}{}'.format( 'pass' if verdict else 'drop',
+				f'{msg.hostname} // ' if msg.hostname else '', summary,
+				f' :: props: {props}' if props else '' ))
+	except CorpusError as err:
+		print(f'ERROR: {err}', file=sys.stderr)
+		return 1
+	if not td_list: return print('No messages found in the corpus')
+	td_sum, td_list = sum(td_list), sorted(td_list)
+	td_pc = lambda pc: td_list[min(len(td_list) - 1, int(len(td_list) * pc / 100))] * 1e6
+	print( f'Messages: {len(td_list)}, passed: {n_pass},'
+		f' dropped: {len(td_list) - n_pass}, filtering time: {td_sum:.3f}s' )
+	print( f'Throughput: {len(td_list) / (td_sum or 1e-9):,.0f} msg/s,'
+		' latency: p50={:.1f}us p90={:.1f}us p99={:.1f}us max={:.1f}us'.format(
+			td_pc(50), td_pc(90), td_pc(99), td_list[-1] * 1e6 ) )
+
 
 
 class NotificationDaemon(dbus.service.Object):
@@ -82,32 +162,45 @@ class NotificationDaemon(dbus.service.Object):
 	dbus_path = '/org/freedesktop/Notifications'
 
 	plugged, timeout_cleanup = False, True
-	_activity_timer = None
+	_activity_timer = _checkpoint = _checkpoint_timer = None
+	_note_id_last = 0
 
 	def __init__(self, bus, pubsub=None, logger=None):
 		# super().__init__(bus, self.dbus_path)
 		dbus.service.Object.__init__( self, bus,
 			self.dbus_path, dbus.service.BusName(self.dbus_iface, bus) )
-		tick_strangle_max = op.truediv(optz.tbf_max_delay, optz.tbf_tick)
-		self._note_limit = core.FC_TokenBucket(
-			tick=optz.tbf_tick, burst=optz.tbf_size,
-			tick_strangle=lambda x: min(x*optz.tbf_inc, tick_strangle_max),
-			tick_free=lambda x: max(op.truediv(x, optz.tbf_dec), 1) )
-		self._note_buffer = core.RRQ(optz.queue_len)
+		self.scheduler = Scheduler()
+		self._note_limit = core.FC_TokenBucketTree(
+			self._note_limit_bucket(), self._note_limit_bucket, size_max=optz.tbf_source_max )
+		self._note_spool = NotificationSpool(optz.queue_spool) if optz.queue_spool else None
+		self._note_buffer = core.PRQ( optz.queue_len, key=self._note_buffer_priority,
+			label=self._note_buffer_label, dedup=self._note_coalesce_key,
+			spill=self._note_spool_add if self._note_spool is not None else None )
 		self._note_history = core.RRQ(optz.history_len)
-		self._note_windows = dict()
+		self._note_windows, self._note_windows_dedup = dict(), dict()
 		self._note_id_pool = it.chain.from_iterable(map(ft.partial(range, 1), it.repeat(2**30)))
 		self._renderer = NotificationDisplay(
 			optz.layout_margin, optz.layout_anchor, optz.layout_direction,
 			icon_scale=optz.icon_scale, markup_default=not optz.markup_disable,
-			markup_warn=optz.markup_warn_on_err, markup_strip=optz.markup_strip_on_err )
+			markup_warn=optz.markup_warn_on_err, markup_strip=optz.markup_strip_on_err,
+			scheduler=self.scheduler, win_pool=optz.win_pool_size, layout_max=optz.layout_max_windows,
+			icon_cache=int(optz.icon_cache_size * 2**20) )
+		if optz.state_checkpoint:
+			self._checkpoint = StateCheckpoint(optz.state_checkpoint, clock=self.scheduler.clock)
+			self._checkpoint_restore()
 		self._activity_event()
+		if self._note_buffer or self._note_spool:
+			self.flush(timeout=poll_interval) # left from previous run
 
 		self.pubsub = pubsub
 		if pubsub:
+			self._net_limits = core.LRUCache(optz.tbf_source_max)
+			self._net_dropped = cs.Counter()
+			self._net_drain_timer = self.scheduler.timer(self._notify_pubsub_drain)
 			GLib.io_add_watch( pubsub.fileno(),
 				GLib.PRIORITY_DEFAULT, GLib.IO_IN | GLib.IO_PRI, self._notify_pubsub )
 		self.logger = logger
+		if optz.filter_monitor: self._filter_monitor_init()
 
 		if optz.test_message:
 			# Also test crazy web-of-90s markup here :P
@@ -133,8 +226,55 @@ class NotificationDaemon(dbus.service.Object):
 
 	def exit(self, reason=None):
 		log.debug(f'Exiting cleanly%s', ', reason: {reason or ""}')
+		if self._checkpoint: self._checkpoint_save()
 		sys.exit()
 
+	def _checkpoint_update(self):
+		'''Schedules --state-checkpoint update, if it's enabled,
+			with only one save per --state-checkpoint-delay for any number of changes.'''
+		if not self._checkpoint: return
+		if not self._checkpoint_timer:
+			self._checkpoint_timer = self.scheduler.timer(self._checkpoint_save)
+		if not self._checkpoint_timer.active:
+			self.scheduler.schedule(self._checkpoint_timer, optz.state_checkpoint_delay)
+
+	def _checkpoint_save(self):
+		self.scheduler.cancel(self._checkpoint_timer)
+		state = dict(
+			history=list(self._note_history), buffer=list(self._note_buffer),
+			buffer_dropped=dict(self._note_buffer.dropped_by), note_id=self._note_id_last,
+			props=dict(urgent=optz.urgency_check, plug=self.plugged, cleanup=self.timeout_cleanup),
+			limits=list((list(key) if key else None, tokens) for key, tokens in self._note_limit.levels()) )
+		ts = time.perf_counter()
+		try: size = self._checkpoint.save(state)
+		except CheckpointError as err: log.warning('Failed to save state checkpoint: %s', err)
+		else: log.debug('Saved state checkpoint (%s B, %.1fms)', size, (time.perf_counter() - ts) * 1000)
+
+	def _checkpoint_restore(self):
+		'''Restores notification history, queue, rate limits,
+			properties and id counter from --state-checkpoint, if any.'''
+		if not (state := self._checkpoint.load()): return
+		for note in state['history']: self._note_history.append(note)
+		for note in state['buffer']: # ids from before restart can clash with new ones
+			note.id = None
+			self._note_buffer_add(note)
+		self._note_buffer.dropped_by.update(state.get('buffer_dropped') or dict())
+		if nid := state.get('note_id'):
+			self._note_id_last = nid
+			self._note_id_pool = it.chain(range(nid + 1, 2**30), self._note_id_pool)
+		props = state.get('props') or dict()
+		optz.urgency_check = props.get('urgent', optz.urgency_check)
+		self.plugged = props.get('plug', self.plugged)
+		self.timeout_cleanup = props.get('cleanup', self.timeout_cleanup)
+		self._note_limit.restore(( (tuple(key) if key else None, tokens)
+			for key, tokens in state.get('limits') or list() ), elapsed=state['age'])
+		log.debug( 'Restored state checkpoint from %s ago (history: %s, queued: %s)',
+			ts_diff_format(state['age']), len(self._note_history), len(self._note_buffer) )
+
+	def _note_id(self):
+		self._note_id_last = nid = next(self._note_id_pool)
+		return nid
+
 	def _activity_event(self, callback=False):
 		if callback:
 			if not self._note_windows:
@@ -142,11 +282,11 @@ class NotificationDaemon(dbus.service.Object):
 			else:
 				log.debug( 'Ignoring inacivity timeout event'
 					' due to existing windows (retry in %ss).', optz.activity_timeout )
-				self._activity_timer = None
-		if self._activity_timer: GLib.source_remove(self._activity_timer)
 		if optz.activity_timeout and optz.activity_timeout > 0:
-			self._activity_timer = GLib.timeout_add_seconds(
-				optz.activity_timeout, self._activity_event, True )
+			# Postponing active timer is cheap, so it's done on every call
+			if not self._activity_timer:
+				self._activity_timer = self.scheduler.timer(self._activity_event, True)
+			self.scheduler.schedule(self._activity_timer, optz.activity_timeout)
 
 
 	@dbus.service.method(dbus_iface, '', 'ssss')
@@ -220,7 +360,7 @@ class NotificationDaemon(dbus.service.Object):
 				log.debug('Notification queue unplugged')
 				if optz.status_notify:
 					self.display('Notification proxy: queue is unplugged')
-				if self._note_buffer:
+				if self._note_buffer or self._note_spool:
 					log.debug('Flushing plugged queue')
 					self.flush()
 
@@ -238,6 +378,7 @@ class NotificationDaemon(dbus.service.Object):
 			return
 
 		self.PropertiesChanged(iface, {k: v}, [])
+		self._checkpoint_update()
 
 	@dbus.service.signal(dbus_props, 'sa{sv}as')
 	def PropertiesChanged(self, iface, props_changed, props_invalidated):
@@ -265,6 +406,23 @@ class NotificationDaemon(dbus.service.Object):
 		note = self._note_history.pop()
 		return self.display(note, redisplay=True)
 
+	@dbus.service.method(dbus_iface, '', 'a{sv}')
+	def Stats(self):
+		log.debug('Stats call')
+		self._activity_event()
+		return self.get_stats()
+
+	@dbus.service.method(dbus_iface, '', 'a(suud)')
+	def FilterProfile(self):
+		log.debug('FilterProfile call')
+		self._activity_event()
+		cb, mtime, res = *self._filter_callback, list()
+		for name, func in cb.items() if cb else list():
+			if not func.profile: continue
+			res.extend( (f'{name}: {func.profile.key_str(k)}', calls, matches, td)
+				for k, (calls, matches, td) in func.profile.items() )
+		return res
+
 	@dbus.service.method(dbus_iface, 'du', '')
 	def Cleanup(self, timeout, max_count):
 		log.debug( 'NotificationCleanup call'
@@ -281,9 +439,16 @@ class NotificationDaemon(dbus.service.Object):
 
 
 	def _notify_pubsub(self, _fd, _ev):
+		self._notify_pubsub_drain()
+		return True # for glib to keep watcher
+
+	def _notify_pubsub_drain(self):
+		'''Processes up to --net-drain-budget messages from pubsub socket,
+			scheduling next batch after other main loop events, if there's more.
+			zmq socket fd is edge-triggered, so it won't be signaled for leftover messages.'''
 		try:
-			while True:
-				msg = self.pubsub.recv()
+			for n in range(optz.net_drain_budget or 2**30):
+				msg = self.pubsub.recv(admit=self._notify_pubsub_admit)
 				if msg is None: break
 				self._activity_event()
 				note = msg.note
@@ -293,10 +458,37 @@ class NotificationDaemon(dbus.service.Object):
 				note.summary = f'{prefix} // {note.summary}'
 				note.hints['x-nt-from-remote'] = msg.hostname
 				self.filter_display(note)
+			else:
+				if not self._net_drain_timer.active: self.scheduler.schedule(self._net_drain_timer, 0)
 		except: log.exception('Unhandled error with remote notification')
-		finally: return True # for glib to keep watcher
 
-	@dbus.service.method(dbus_iface, 'susssasa{sv}i', 'u')
+	def _notify_pubsub_admit(self, hostname):
+		'''Checks per-peer --net-ingress-* limit for hostname from message header,
+			before decoding it, returning False to drop it and count as such.'''
+		if not optz.net_ingress_burst: return True
+		if not (limit := self._net_limits.get(hostname)):
+			limit = self._net_limits[hostname] = core.FC_GCRA( optz.net_ingress_burst,
+				optz.net_ingress_tick, clock=self.scheduler.clock )
+		if limit.consume(): return True
+		if not self._net_dropped:
+			self.scheduler.add(poll_interval, self._notify_pubsub_dropped)
+		self._net_dropped[hostname] += 1
+		return False
+
+	def _notify_pubsub_dropped(self):
+		'''Reports messages dropped by --net-ingress-* limits since the first one,
+			as a single summary per poll_interval, instead of one for each message.'''
+		dropped, self._net_dropped = self._net_dropped, cs.Counter()
+		if not dropped: return
+		hosts = ', '.join(f'{host} [{n}]' for host, n in dropped.most_common())
+		log.warning('Dropped remote notifications over ingress limit: %s', hosts)
+		if optz.status_notify:
+			self.display( 'notification-thing: dropped'
+				f' {sum(dropped.values())} remote notification(s)', f'From: {hosts}' )
+
+	# byte_arrays=True makes dbus-python return "ay" image-data as bytes,
+	#  instead of dbus.Array with dbus.Byte object for each byte in it
+	@dbus.service.method(dbus_iface, 'susssasa{sv}i', 'u', byte_arrays=True)
 	def Notify(self, app_name, nid, icon, summary, body, actions, hints, timeout):
 		self._activity_event()
 		try:
@@ -307,7 +499,6 @@ class NotificationDaemon(dbus.service.Object):
 				except Exception as err:
 					log.info('Failed to attach plain version to net message: %s', err)
 				self.pubsub.send(note)
-			if nid: self.close(nid, reason=close_reasons.closed)
 			return self.filter_display(note)
 		except Exception:
 			log.exception('Unhandled error')
@@ -322,26 +513,92 @@ class NotificationDaemon(dbus.service.Object):
 
 	_filter_ts_chk = 0
 	_filter_callback = None, 0
+	_filter_monitor = _filter_reload_timer = _filter_workers = None
+	filter_reload_delay = 0.5 # to debounce multiple events from editors
 
-	def _notification_check(self, summary, body, note=None):
-		(cb, mtime), ts = self._filter_callback, time.monotonic()
+	def _filter_monitor_init(self):
+		'''Setup inotify-based reload of filter file/dir via Gio.FileMonitor.
+			Polling for mtime changes every poll_interval is used if this fails.
+			Monitor watches file path, so replacing file via rename is also detected.'''
+		try:
+			self._filter_monitor = [Gio.File.new_for_path(optz.filter_file)\
+				.monitor_file(Gio.FileMonitorFlags.WATCH_MOVES, None)]
+			if optz.filter_dir:
+				self._filter_monitor.append(Gio.File.new_for_path(optz.filter_dir)\
+					.monitor_directory(Gio.FileMonitorFlags.WATCH_MOVES, None))
+		except GLib.GError as err:
+			log.warning('Failed to setup filter file monitor, will poll it instead: %s', err)
+			self._filter_monitor = None
+			return
+		for mon in self._filter_monitor: mon.connect('changed', self._filter_monitor_event)
+		self._filter_load()
+
+	def _filter_monitor_event(self, mon, src, dst, ev):
+		log.debug('Filter file event: %s', ev.value_nick)
+		if not self._filter_reload_timer:
+			self._filter_reload_timer = self.scheduler.timer(self._filter_reload)
+		self.scheduler.schedule(self._filter_reload_timer, self.filter_reload_delay)
+
+	def _filter_reload(self):
+		self._filter_load(force=True)
+
+	def _filter_mtime(self):
+		'''Returns max mtime of optz.filter_file, optz.filter_dir and files in it,
+			which is used to detect changes in any of these, or None if there are no filters.'''
+		paths, ts_dir = [optz.filter_file], None
+		if optz.filter_dir and os.path.isdir(optz.filter_dir):
+			ts_dir = os.stat(optz.filter_dir).st_mtime # changes on file removal
+			paths.extend(os.path.join(optz.filter_dir, fn) for fn in os.listdir(optz.filter_dir))
+		ts_list = list()
+		for p in paths:
+			try: ts_list.append(os.stat(p).st_mtime)
+			except (OSError, IOError): pass
+		if not ts_list: return None
+		return int(max(ts_list + [ts_dir or 0]))
+
+	def _filter_load(self, force=False):
+		'''(Re)Load filters from optz.filter_file and optz.filter_dir
+			if their mtime changed, or unconditionally with force=True.'''
+		cb, mtime = self._filter_callback
+		ts = self._filter_mtime()
+		if ts is None:
+			if cb: log.debug('Filter files are missing or inaccessible, disabling filtering')
+			self._filter_callback = None, 0
+			return
+		if not force and ts <= mtime: return
+		try:
+			cb = core.get_filter_index( optz.filter_file, optz.filter_dir,
+				sound_env=optz.filter_sound, cache_size=optz.filter_cache,
+				profile=optz.filter_profile, parse_cache_dir=optz.filter_parse_cache )
+		except:
+			ex, self._filter_callback = traceback.format_exc(), (None, 0)
+			log.debug( 'Failed to load'
+				' notification filters (from %s / %s):\n%s', optz.filter_file, optz.filter_dir, ex )
+			if optz.status_notify:
+				self.display('notification-thing: failed to load notification filters', ex)
+		else:
+			log.debug('(Re)Loaded notification filters: %s', ', '.join(k for k, f in cb.items()))
+			self._filter_callback = cb, ts
+			if optz.filter_workers > 0:
+				if not self._filter_workers:
+					self._filter_workers = FilterWorkers(
+						optz.filter_file, optz.filter_dir, optz.filter_workers,
+						timeout=optz.filter_worker_timeout,
+						fail_open=not optz.filter_worker_fail_closed,
+						sound=bool(optz.filter_sound), cache_size=optz.filter_cache,
+						parse_cache_dir=optz.filter_parse_cache, scheduler=self.scheduler )
+				else: self._filter_workers.restart()
+
+	def _filter_poll(self):
+		if self._filter_monitor: return
+		ts = time.monotonic() # stat-polling fallback
 		if self._filter_ts_chk < ts - poll_interval:
 			self._filter_ts_chk = ts
-			try: ts = int(os.stat(optz.filter_file).st_mtime)
-			except (OSError, IOError): return True
-			if ts > mtime:
-				mtime = ts
-				try: cb = core.get_filter(optz.filter_file, optz.filter_sound)
-				except:
-					ex, self._filter_callback = traceback.format_exc(), (None, 0)
-					log.debug( 'Failed to load'
-						' notification filters (from %s):\n%s', optz.filter_file, ex )
-					if optz.status_notify:
-						self.display('notification-thing: failed to load notification filters', ex)
-					return True
-				else:
-					log.debug('(Re)Loaded notification filters')
-					self._filter_callback = cb, mtime
+			self._filter_load()
+
+	def _notification_check(self, summary, body, note=None):
+		self._filter_poll()
+		cb, mtime = self._filter_callback
 		if cb is None: return True # no filtering defined
 		elif not callable(cb): return bool(cb)
 		try: return cb(summary, body, note)
@@ -352,6 +609,159 @@ class NotificationDaemon(dbus.service.Object):
 				self.display('notification-thing: notification filters failed', ex)
 			return True
 
+	_cost_stats = None
+
+	def _note_cost_stats(self, note, render_time):
+		'''Record token cost and window creation time of displayed notification,
+			to compare these in "Stats", and see if --tbf-cost-weights match actual cost.'''
+		if self._cost_stats is None: self._cost_stats = cs.defaultdict(lambda: [0, 0, 0])
+		cost = getattr(note, 'cost', None)
+		if cost is None: cost = self._note_cost(note)
+		for k in 'all', 'cost_{}'.format(min(int(cost), 10)):
+			st = self._cost_stats[k]
+			st[0], st[1], st[2] = st[0] + 1, st[1] + cost, st[2] + render_time
+
+	def get_stats(self):
+		'Returns flat dict of daemon counters, with dot-separated keys.'
+		stats = dict()
+		cb, mtime = self._filter_callback
+		caches = list(func.cache for name, func in cb.items() if func.cache) if cb else list()
+		stats['filter_cache.enabled'] = bool(caches)
+		stats['filter_count'] = len(cb.items()) if cb else 0
+		for cache in caches:
+			for k, v in cache.stats().items():
+				stats[f'filter_cache.{k}'] = stats.get(f'filter_cache.{k}', 0) + v
+		if (cache := getattr(self._renderer, 'icon_cache', None)) is not None:
+			for k, v in cache.stats().items(): stats[f'icon_cache.{k}'] = v
+		stats['tbf.tokens'] = self._note_limit.tokens
+		stats['tbf.sources'] = len(self._note_limit)
+		stats['tbf.sources_evicted'] = self._note_limit.evicted
+		if self.pubsub:
+			stats['net.peers'] = len(self._net_limits)
+			stats['net.dropped_pending'] = sum(self._net_dropped.values())
+		for k, (n, cost, td) in sorted((self._cost_stats or dict()).items()):
+			stats[f'render.{k}.count'], stats[f'render.{k}.tokens'] = n, cost
+			stats[f'render.{k}.ms_total'] = td * 1000
+			stats[f'render.{k}.ms_per_token'] = td * 1000 / (cost or 1)
+		return stats
+
+	def _note_limit_bucket(self, key=None):
+		'''Returns new flow control object (--tbf-policy) with global --tbf-* parameters,
+				or ones for specific source key from --tbf-source-settings.
+			Source key is a tuple of (type, name), e.g. ("app", "firefox"),
+				and settings for it are looked up by "app" and "app.firefox" keys there.
+			Per-source buckets get --tbf-source-share of global size and rate by default,
+				so that one source can't use up all tokens in the global bucket by itself.
+			None is returned if settings for key are set to false value.'''
+		conf = dict( policy=optz.tbf_policy, size=optz.tbf_size, tick=optz.tbf_tick,
+			max_delay=optz.tbf_max_delay, inc=optz.tbf_inc, dec=optz.tbf_dec )
+		if key:
+			share = optz.tbf_source_share
+			conf.update(size=max(1, int(conf['size'] * share)), tick=conf['tick'] / share)
+			for k in key[0], '{}.{}'.format(*key):
+				v = (optz.tbf_source_settings or dict()).get(k, True)
+				if not v: return None
+				if v is not True: conf.update(v)
+		if conf['policy'] != 'token-bucket':
+			return core.flow_control_policies[conf['policy']](
+				burst=conf['size'], tick=conf['tick'], clock=self.scheduler.clock )
+		tick_strangle_max = op.truediv(conf['max_delay'], conf['tick'])
+		return core.FC_TokenBucket(
+			tick=conf['tick'], burst=conf['size'], clock=self.scheduler.clock,
+			tick_strangle=lambda x: min(x*conf['inc'], tick_strangle_max),
+			tick_free=lambda x: max(op.truediv(x, conf['dec']), 1) )
+
+	def _note_cost(self, note):
+		'''Returns number of rate-limiting tokens that notification costs,
+				based on its text size, markup and icon size, with --tbf-cost-weights.
+			Always 1 (one token per notification) if these weights are not set.'''
+		if not (w := optz.tbf_cost_weights): return 1
+		cost = w.get('base', 1)
+		if k := w.get('chars'): cost += k * (len(note.summary) + len(note.body)) / 1000
+		if k := w.get('lines'): cost += k * note.body.count('\n')
+		if (k := w.get('markup')) and '<' in note.body\
+			and note.hints.get('x-nt-markup', not optz.markup_disable): cost += k
+		if k := w.get('icon_px'):
+			for hint in core.image_data_hints:
+				if not (image := note.hints.get(hint)): continue
+				try: cost += k * int(image[0]) * int(image[1]) / 10_000
+				except (TypeError, ValueError, IndexError): pass
+				break
+		return max(0, cost)
+
+	def _note_limit_keys(self, note):
+		'Returns token bucket keys for notification source(s).'
+		keys = [('app', note.get('app_name') or '')]
+		if host := note.hints.get('x-nt-from-remote'): keys.append(('host', str(host)))
+		return keys
+
+	def _note_urgency(self, note, default=None):
+		try: return int(note.hints['urgency'])
+		except (KeyError, ValueError): return default
+
+	def _note_buffer_priority(self, note):
+		'''Priority of queued notification, where ones with lowest value get dropped
+			from queue first on overflow - (urgency, app weight), with oldest ones dropped
+			first among same-priority ones. App weights are from --queue-app-weights option.'''
+		return ( self._note_urgency(note, core.urgency_levels.normal),
+			(optz.queue_app_weights or dict()).get(note.get('app_name'), 0) )
+
+	def _note_buffer_label(self, note):
+		try: return core.urgency_levels.by_id(self._note_urgency(note))
+		except KeyError: return 'normal'
+
+	def _note_coalesce_key(self, note):
+		'''Returns hash of --coalesce-key fields of the note, with case and whitespace
+			differences ignored, or None if coalescing duplicates is disabled.'''
+		if not optz.coalesce_key: return None
+		key = getattr(note, 'coalesce_key', None)
+		if key is None:
+			key = '\0'.join(' '.join(str(note.get(k) or '').split()).casefold() for k in optz.coalesce_key)
+			key = note.coalesce_key = hashlib.blake2b(key.encode(), digest_size=16).digest()
+		return key
+
+	def _note_coalesce_merge(self, note, dup):
+		'Merge note into earlier duplicate one, updating its repeat counter and timestamps.'
+		dup.repeat = getattr(dup, 'repeat', 1) + getattr(note, 'repeat', 1)
+		dup.repeat_ts = getattr(dup, 'repeat_ts', (dup.created, dup.created))[0], self.scheduler.clock()
+
+	def _note_coalesce(self, note):
+		'''Merges note into already-displayed duplicate one within --coalesce-window,
+			updating its window in-place and returning its id, or returns None if there is none.'''
+		if not (key := self._note_coalesce_key(note)): return
+		nid = self._note_windows_dedup.get(key)
+		if not (dup := self._note_windows.get(nid)): return
+		ts = self.scheduler.clock()
+		if ts - getattr(dup, 'repeat_ts', (0, dup.created))[1] > optz.coalesce_window: return
+		self._note_coalesce_merge(note, dup)
+		try: self._renderer.update(nid, dup.summary, self._note_repeat_body(dup))
+		except self._renderer.NoWindowError: return
+		if timer := getattr(dup, 'timer', None): # restart expiry timer
+			if timer.active: self.scheduler.schedule(timer, dup.timeout / 1000.0)
+			elif timer.left is not None: timer.left = dup.timeout / 1000.0 # paused on hover
+		log.debug('Coalesced duplicate notification (id: %s, repeats: %s)', nid, dup.repeat)
+		return nid
+
+	def _note_repeat_body(self, note):
+		if (n := getattr(note, 'repeat', 1)) <= 1: return note.body
+		ts0, ts1 = note.repeat_ts
+		return f'{note.body}\n\n[repeated {n} times over {ts_diff_format(ts1 - ts0)}]'
+
+	def _note_spool_add(self, note):
+		'Store notification dropped from in-memory buffer in --queue-spool file.'
+		try:
+			self._note_spool.append( time.time() - (self.scheduler.clock() - note.created),
+				self._note_urgency(note), note.app_name, note.summary, self._note_repeat_body(note) )
+		except SpoolError as err:
+			log.warning('Failed to spool notification, dropping it: %s', err)
+			return False
+		return True
+
+	def _note_buffer_add(self, note):
+		if (dup := self._note_buffer.append(note)) is not None:
+			self._note_coalesce_merge(note, dup)
+		self._checkpoint_update()
+
 	def _note_plaintext(self, note):
 		note_plain = note.get('plain')
 		if note_plain: summary, body = note_plain
@@ -376,9 +786,32 @@ class NotificationDaemon(dbus.service.Object):
 	def filter_display(self, note):
 		'Main method which all notifications are passed to for processing/display.'
 		note_summary, note_body = self._note_plaintext(note)
+		self._filter_poll()
+		if self._filter_workers and self._filter_callback[0]:
+			# Async filtering - id is allocated here to be returned to the sender
+			note.id = note.replaces_id\
+				if note.replaces_id in self._note_windows else self._note_id()
+			hints = dict( (k, str(note.hints[k])) # only ones used in FilterIndex
+				for k in ['x-nt-from-remote', 'category'] if k in note.hints )
+			self._filter_workers.check( note_summary, note_body, note.app_name, hints,
+				ft.partial(self._filter_worker_result, note, note_summary, note_body) )
+			return note.id
 		filter_pass = self._notification_check(note_summary, note_body, note)
-		try: urgency = int(note.hints['urgency'])
-		except (KeyError, ValueError): urgency = None
+		return self._filter_display_result(note, note_summary, note_body, filter_pass)
+
+	def _filter_worker_result(self, note, note_summary, note_body, filter_pass, props, err):
+		if err:
+			log.debug('Failed to run notification filters:\n%s', err)
+			if optz.status_notify:
+				self.display('notification-thing: notification filters failed', err)
+		for k, v in (props or dict()).items():
+			if k != 'hints': note[k] = v
+			else: note.hints.update(v)
+		self._filter_display_result(note, note_summary, note_body, filter_pass)
+
+	def _filter_display_result(self, note, note_summary, note_body, filter_pass):
+		'Passes filtered notification through logging, rate-limiting and display.'
+		urgency = self._note_urgency(note)
 
 		if self.logger and (filter_pass or optz.log_filtered):
 			try:
@@ -391,24 +824,35 @@ class NotificationDaemon(dbus.service.Object):
 
 		if not filter_pass:
 			log.debug('Dropped notification due to negative filtering result: %r', note_summary)
+			if note.replaces_id: self.close(note.replaces_id, reason=close_reasons.closed)
 			return 0
 
+		if nid := self._note_coalesce(note): return nid
+
+		if note.replaces_id in self._note_windows:
+			log.debug('Replacing displayed notification (id: %s)', note.replaces_id)
+			return self.display(note) # in-place update, not rate-limited
+		if note.replaces_id: # replaced one was closed or not displayed
+			self.close(note.replaces_id, reason=close_reasons.closed)
+
+		limit_keys, note.cost = self._note_limit_keys(note), self._note_cost(note)
 		if optz.urgency_check and urgency == core.urgency_levels.critical:
-			self._note_limit.consume()
+			self._note_limit.consume(limit_keys, note.cost)
 			log.debug('Urgent message immediate passthru, tokens left: %s', self._note_limit.tokens)
 			return self.display(note)
 
 		plug = self.plugged or (optz.fs_check and self._fullscreen_check())
-		if plug or not self._note_limit.consume(): # Delay notification
-			to = self._note_limit.get_eta() if not plug else poll_interval
-			self._note_buffer.append(note)
+		if plug or not self._note_limit.consume(limit_keys, note.cost): # Delay notification
+			to = self._note_limit.get_eta(limit_keys, note.cost) if not plug else poll_interval
+			self._note_buffer_add(note)
 			log.debug( 'Queueing notification. Reason: %s. Flush attempt in %ss',
 				'plug or fullscreen window detected' if plug else 'notification rate limit', to )
 			self.flush(timeout=to)
 			return 0
 
 		if self._note_buffer:
-			self._note_buffer.append(note)
+			note.limit_paid = True # tokens for its sources were consumed above
+			self._note_buffer_add(note)
 			log.debug('Token-flush of notification buffer')
 			self.flush()
 			return 0
@@ -420,20 +864,22 @@ class NotificationDaemon(dbus.service.Object):
 	_flush_timer = _flush_id = None
 
 	def flush(self, force=False, timeout=None):
-		if self._flush_timer:
-			GLib.source_remove(self._flush_timer)
-			self._flush_timer = None
+		if not self._flush_timer: self._flush_timer = self.scheduler.timer(self.flush)
 		if timeout:
+			deadline = self.scheduler.clock() + timeout
+			if self._flush_timer.active and self._flush_timer.deadline <= deadline:
+				return # only one wakeup for earliest flush time is needed
 			log.debug('Scheduled notification buffer flush in %ss', timeout)
-			self._flush_timer = GLib.timeout_add(int(timeout * 1000), self.flush)
+			self.scheduler.schedule(self._flush_timer, timeout)
 			return
-		if not self._note_buffer:
+		self.scheduler.cancel(self._flush_timer)
+		if not (self._note_buffer or self._note_spool):
 			log.debug('Flush event with empty notification buffer')
 			return
 
 		log.debug(
-			'Flushing notification buffer (%s msgs, %s dropped)',
-			len(self._note_buffer), self._note_buffer.dropped )
+			'Flushing notification buffer (%s msgs, %s dropped, %s spooled)',
+			len(self._note_buffer), self._note_buffer.dropped, len(self._note_spool or '') )
 
 		self._note_limit.consume(force=True)
 		if not force:
@@ -445,17 +891,37 @@ class NotificationDaemon(dbus.service.Object):
 
 		if self._note_buffer:
 			# Decided not to use replace_id here - several feeds are okay
-			self._flush_id = self.display( self._note_buffer[0]\
-				if len(self._note_buffer) == 1\
-				else core.Notification.system_message(
-					'Feed' if not self._note_buffer.dropped
-						else f'Feed ({self._note_buffer.dropped} dropped)',
-					'\n\n'.join(it.starmap( '--- {}\n  {}'.format,
-						map(op.itemgetter('summary', 'body'), self._note_buffer) )),
-					app_name='notification-feed', icon=optz.feed_icon ) )
+			notes, dropped = list(self._note_buffer), self._note_buffer.dropped_by
+			for note in notes: # feed only counts as one message in global bucket, but not for sources
+				if getattr(note, 'limit_paid', False): continue
+				cost = getattr(note, 'cost', None)
+				self._note_limit.consume( self._note_limit_keys(note),
+					self._note_cost(note) if cost is None else cost, force=True, nested_only=True )
+			spooled = f', {len(self._note_spool)} more spooled' if self._note_spool else ''
+			if len(notes) == 1 and not spooled: # duplicate could've been displayed since it was queued
+				self._flush_id = self._note_coalesce(notes[0]) or self.display(notes[0])
+			else: self._flush_id = self.display(core.Notification.system_message(
+					f'Feed{spooled}' if not dropped else 'Feed ({} dropped: {}{})'.format(
+						sum(dropped.values()), ', '.join(f'{n} {k}' for k, n in sorted(
+							dropped.items(), key=lambda kn: core.urgency_levels.get(kn[0], 1) )), spooled),
+					'\n\n'.join( '--- {}\n  {}'.format(
+						note.summary, self._note_repeat_body(note) ) for note in notes ),
+					app_name='notification-feed', icon=optz.feed_icon ))
 			self._note_buffer.flush()
+			self._checkpoint_update()
 			log.debug('Notification buffer flushed')
 
+		elif self._note_spool: # one page per flush, after in-memory buffer
+			page = self._note_spool.read(optz.queue_spool_page)
+			self._flush_id = self.display(core.Notification.system_message(
+				'Feed (spooled{})'.format(f', {len(self._note_spool)} more' if self._note_spool else ''),
+				'\n\n'.join(f'--- {summary}\n  {body}' for ts, urgency, app, summary, body in page),
+				app_name='notification-feed', icon=optz.feed_icon ))
+			log.debug('Flushed %s spooled notification(s)', len(page))
+
+		if self._note_spool: # next page, as rate-limiting allows
+			self.flush(timeout=max(self._note_limit.get_eta(), 1))
+
 
 	def display(self, note_or_summary, body='', redisplay=False):
 		if isinstance(note_or_summary, core.Notification):
@@ -468,27 +934,47 @@ class NotificationDaemon(dbus.service.Object):
 			clone = note.clone()
 			clone.display_time = time.monotonic()
 			self._note_history.append(clone)
+			self._checkpoint_update()
 		else:
 			ts = getattr(note, 'display_time', None)
 			if ts: note.body += ( '\n\n[from '
 				f'{ts_diff_format(time.monotonic() - ts, add_ago=True)}]' )
 
-		if note.replaces_id in self._note_windows:
-			self.close(note.replaces_id, close_reasons.closed)
-			note.id = self._note_windows[note.replaces_id]
-		else: note.id = next(self._note_id_pool)
+		paused = False # new timer stays paused if old one was, e.g. on mouse hover
+		if replaced := self._note_windows.get(note.replaces_id):
+			note.id = note.replaces_id
+			if timer := getattr(replaced, 'timer', None):
+				paused = timer.paused
+				self.scheduler.cancel(timer)
+			key = getattr(replaced, 'coalesce_key', None)
+			if self._note_windows_dedup.get(key) == note.id: del self._note_windows_dedup[key]
+		else: # id can be pre-allocated in filter_display
+			note.id = getattr(note, 'id', None) or self._note_id()
 		nid = note.id
 
-		self._renderer.display( note,
-			cb_hover=ft.partial(self.close, delay=True),
-			cb_leave=ft.partial(self.close, delay=False),
-			cb_dismiss=ft.partial(self.close, reason=close_reasons.dismissed) )
+		note_render = note
+		if getattr(note, 'repeat', 1) > 1: # coalesced in buffer
+			note_render = note.clone()
+			note_render.id, note_render.body = nid, self._note_repeat_body(note)
+		ts = time.perf_counter()
+		if replaced:
+			try: self._renderer.update_note(nid, note_render)
+			except self._renderer.NoWindowError: replaced = paused = None
+		if not replaced:
+			self._renderer.display( note_render,
+				cb_hover=ft.partial(self.close, delay=True),
+				cb_leave=ft.partial(self.close, delay=False),
+				cb_dismiss=ft.partial(self.close, reason=close_reasons.dismissed),
+				cb_hidden=lambda nid, hidden: self.close(nid, delay=hidden) )
+		self._note_cost_stats(note, time.perf_counter() - ts)
 		self._note_windows[nid] = note
+		if not redisplay and (key := self._note_coalesce_key(note)):
+			self._note_windows_dedup[key] = nid
 
 		if self.timeout_cleanup and note.timeout > 0:
-			note.timer_created, note.timer_left = time.monotonic(), note.timeout / 1000.0
-			note.timer_id = GLib.timeout_add(
-				note.timeout, self.close, nid, close_reasons.expired )
+			note.timer = self.scheduler.add(
+				note.timeout / 1000.0, self.close, nid, close_reasons.expired )
+			if paused: self.scheduler.pause(note.timer)
 
 		log.debug(
 			'Created notification (id: %s, timeout: %s (ms))',
@@ -500,20 +986,15 @@ class NotificationDaemon(dbus.service.Object):
 		if nid:
 			note = self._note_windows.get(nid, None)
 			if note:
-				if getattr(note, 'timer_id', None):
-					GLib.source_remove(note.timer_id)
-
-				if delay is None: del self._note_windows[nid]
-				elif hasattr(note, 'timer_id'): # these get sent very often
-					if delay:
-						if note.timer_id:
-							note.timer_id, note.timer_left = None,\
-								note.timer_left - (time.monotonic() - note.timer_created)
-					else:
-						note.timer_created = time.monotonic()
-						note.timer_id = GLib.timeout_add(
-							int(max(note.timer_left, 1) * 1000),
-							self.close, nid, close_reasons.expired )
+				timer = getattr(note, 'timer', None)
+				if delay is None:
+					self.scheduler.cancel(timer)
+					del self._note_windows[nid]
+					key = getattr(note, 'coalesce_key', None)
+					if self._note_windows_dedup.get(key) == nid: del self._note_windows_dedup[key]
+				elif timer: # these get sent very often, and are no-op if already paused/resumed
+					if delay: self.scheduler.pause(timer)
+					else: self.scheduler.resume(timer, delay_min=1)
 					return
 
 			if delay is None: # try it, even if there's no note object
@@ -529,6 +1010,119 @@ class NotificationDaemon(dbus.service.Object):
 
 
 
+class NotificationSimulator(NotificationDaemon):
+	'''Headless NotificationDaemon, running same filtering, rate-limiting
+			and buffering logic, but with VirtualScheduler clock and no dbus/gtk parts,
+			recording stats on what gets displayed and when.
+		Does not call NotificationDaemon.__init__ and overrides all methods using dbus/gtk.'''
+
+	class Renderer:
+		NoWindowError = NotificationDisplay.NoWindowError
+		def __init__(self, clock): self.clock, self.windows, self.popups = clock, set(), list()
+		def display(self, note, **cbs):
+			self.windows.add(note.id)
+			self.popups.append(self.clock())
+		def update(self, nid, summary, body):
+			if nid not in self.windows: raise self.NoWindowError(nid)
+		def update_note(self, nid, note): self.update(nid, note.summary, note.body)
+		def close(self, nid):
+			try: self.windows.remove(nid)
+			except KeyError: raise self.NoWindowError(nid)
+		def get_note_text(self, note):
+			if not note.hints.get('x-nt-markup', not optz.markup_disable): return note.summary, note.body
+			return strip_markup(note.summary), strip_markup(note.body)
+
+	fullscreen = False
+
+	def __init__(self):
+		self.scheduler = VirtualScheduler()
+		self._note_limit = core.FC_TokenBucketTree(
+			self._note_limit_bucket(), self._note_limit_bucket, size_max=optz.tbf_source_max )
+		self._note_buffer = core.PRQ( optz.queue_len, key=self._note_buffer_priority,
+			label=self._note_buffer_label, dedup=self._note_coalesce_key )
+		self._note_history = core.RRQ(0)
+		self._note_windows, self._note_windows_dedup = dict(), dict()
+		self._note_id_pool = it.count(1)
+		self._renderer, self.logger, self.pubsub = self.Renderer(self.scheduler.clock), None, None
+		self.messages, self.delays, self.feeds, self.dropped = 0, list(), list(), cs.Counter()
+		self._note_spool = None
+
+	def _fullscreen_check(self): return self.fullscreen
+	def _activity_event(self, callback=False): pass
+	def NotificationClosed(self, nid, reason=None): pass
+
+	def display(self, note_or_summary, body='', redisplay=False):
+		if getattr(note_or_summary, 'sim_queued', None) is not None:
+			self.delays.append(self.scheduler.clock() - note_or_summary.sim_queued)
+		return super().display(note_or_summary, body, redisplay)
+
+	def flush(self, force=False, timeout=None):
+		notes = list(self._note_buffer) if not timeout else None
+		dropped = self._note_buffer.dropped_by.copy()
+		super().flush(force=force, timeout=timeout)
+		if not notes or self._note_buffer: return # not flushed
+		if len(notes) > 1:
+			ts = self.scheduler.clock()
+			self.feeds.append(len(notes))
+			self.delays.extend(ts - note.sim_queued for note in notes)
+		self.dropped.update(dropped)
+
+	def replay(self, trace, flush_wait=3600):
+		'''Run notifications and TraceEvents from trace through the daemon logic,
+			advancing virtual clock to their timestamps, and waiting for up to
+			flush_wait seconds after the last one for queued notifications to be flushed.'''
+		ts0 = ts = None
+		for msg in trace:
+			if msg.ts is None: raise CorpusError(f'Trace entry without timestamp: {msg}')
+			if ts0 is None: ts0 = self.scheduler.ts = msg.ts
+			ts = max(ts or msg.ts, msg.ts)
+			self.scheduler.run_until(ts)
+			if isinstance(msg, TraceEvent):
+				if msg.name == 'plug':
+					self.plugged = msg.value
+					if not msg.value and self._note_buffer: self.flush()
+				elif msg.name == 'fullscreen': self.fullscreen = msg.value
+				continue
+			note, self.messages = msg.note, self.messages + 1
+			note.created = note.sim_queued = ts
+			if msg.hostname: note.hints.setdefault('x-nt-from-remote', msg.hostname)
+			self.filter_display(note)
+		if ts0 is None: return 0
+		while self._note_buffer and (deadline := self.scheduler.next_deadline):
+			if deadline > ts + flush_wait: break
+			self.scheduler.run_until(deadline)
+		self.dropped.update(self._note_buffer.dropped_by)
+		return ts - ts0
+
+def rate_simulate(trace, flush_wait=3600):
+	'''Replay notification trace with timestamps (NotificationCorpus) through the
+			filtering, rate-limiting and buffering logic of the daemon with virtual clock,
+			printing stats on popup rates, queueing delays, feed sizes and dropped messages.
+		Plug/fullscreen state changes can be specified in the trace as TraceEvent entries.'''
+	sim = NotificationSimulator()
+	try: td = sim.replay(trace, flush_wait=flush_wait)
+	except CorpusError as err:
+		print(f'ERROR: {err}', file=sys.stderr)
+		return 1
+	if not sim.messages: return print('No messages found in the trace')
+	pc = lambda vals, n: vals[min(len(vals) - 1, int(len(vals) * n / 100))]
+	popups = sim._renderer.popups
+	minutes = cs.Counter(int(ts // 60) for ts in popups)
+	print( f'Messages: {sim.messages}, time span: {ts_diff_format(td)}, popups: {len(popups)},'
+		' per minute: avg={:.2f} max={}'.format(
+			len(popups) / max(td / 60, 1), max(minutes.values(), default=0) ) )
+	if delays := sorted(sim.delays):
+		print( 'Queue delay: p50={:.1f}s p90={:.1f}s p99={:.1f}s max={:.1f}s'.format(
+			pc(delays, 50), pc(delays, 90), pc(delays, 99), delays[-1] ) )
+	if feeds := sorted(sim.feeds):
+		print( f'Feeds: {len(feeds)}, messages in these: {sum(feeds)},'
+			f' size: p50={pc(feeds, 50)} max={feeds[-1]}' )
+	print('Dropped: {}{}'.format( sum(sim.dropped.values()), ' ({})'.format(', '.join(
+		f'{n} {k}' for k, n in sorted(sim.dropped.items()) )) if sim.dropped else '' ))
+	if sim._note_buffer: print(f'Still queued at the end: {len(sim._note_buffer)}')
+
+
+
 def main(argv=None):
 	global optz, log
 	import argparse
@@ -554,11 +1148,48 @@ def main(argv=None):
 		help='Default timeout for notification popups removal (default: %(default)sms)')
 	group.add_argument('-q', '--queue-len',
 		type=int, default=optz['queue_len'], metavar='n',
-		help='How many messages should be queued on tbf overflow (default: %(default)s)')
+		help='How many messages should be queued on tbf overflow (default: %(default)s).'
+			' Lowest-urgency (and --queue-app-weights) messages are dropped first on overflow.')
+	group.add_argument('--coalesce-key',
+		default='', metavar='fields',
+		help='Comma-separated notification fields (any of: summary, body, app_name),'
+				' which are used to detect duplicate messages, with case and whitespace'
+				' differences ignored, e.g. "summary,body,app_name". Disabled by default.'
+			' Duplicates of already-displayed notification within --coalesce-window update'
+				' its window in-place with a repeat counter, instead of creating a new one,'
+				' and queued duplicates (e.g. while plugged) become a single feed entry.')
+	group.add_argument('--coalesce-window',
+		type=float, default=60, metavar='seconds',
+		help='Time window since last duplicate notification, within which next'
+			' one is coalesced with displayed one (default: %(default)ss).')
+	group.add_argument('--queue-spool', metavar='path',
+		help='File to store notifications in, instead of dropping them when'
+				' --queue-len overflows, e.g. during a long plug or fullscreen app.'
+			' These are flushed in pages of --queue-spool-page messages after the'
+				' in-memory queue, one feed notification per rate-limiting interval.'
+			' Not used by default.')
+	group.add_argument('--queue-spool-page',
+		type=int, default=20, metavar='n',
+		help='Number of spooled messages to display in one feed notification (default: %(default)s).')
+	group.add_argument('--queue-app-weights', metavar='yaml',
+		help='Optional yaml/json encoded mapping of app_name to numeric weight,'
+				' to drop messages with lower weight first from overflowing queue,'
+				' among ones with same urgency. Default weight is 0.'
+			' Example: {Pidgin: -1, build-bot: 10}.')
 	group.add_argument('-s', '--history-len',
 		type=int, default=optz['history_len'], metavar='n',
 		help='How many last *displayed* messages to'
 			' remember to display again on demand (default: %(default)s)')
+	group.add_argument('--state-checkpoint', metavar='dir',
+		help='Directory to save daemon state to - notification history and queue,'
+				' rate-limiting state, urgent/plug/cleanup properties and id counter -'
+				' to restore it from there on next start, e.g. after --activity-timeout.'
+			' Image data from notifications is stored there in separate files by content hash.'
+			' Not used by default.')
+	group.add_argument('--state-checkpoint-delay',
+		type=float, default=5, metavar='seconds',
+		help='Delay to save state in after it changes, to batch'
+			' updates together, also saved on clean exit (default: %(default)ss).')
 
 	group = parser.add_argument_group('Test/startup messages and sounds')
 	group.add_argument('--test-message', action='store_true',
@@ -581,9 +1212,64 @@ def main(argv=None):
 	group = parser.add_argument_group('Scheme-based notification filtering')
 	group.add_argument('--filter-file', default='~/.notification_filter', metavar='path',
 		help='Read simple scheme rules for filtering notifications from file (default: %(default)s).')
+	group.add_argument('--filter-dir', default='~/.notification_filter.d', metavar='path',
+		help='Directory with per-source filter files, used instead of --filter-file'
+				' for matching notifications, if present (default: %(default)s).'
+			' Files there must be named "<key>.<name>", where key is one of "host"'
+				' (remote hostname), "app" (app_name) or "category" (category hint),'
+				' e.g. "app.firefox", and are checked in that key order.'
+			' Empty value disables it.')
 	group.add_argument('--filter-test', nargs=2, metavar=('summary', 'body'),
 		help='Do not start daemon, just test given summary'
 			' and body against filter-file and print the result back to terminal.')
+	group.add_argument('--filter-bench', type=int, metavar='count',
+		help='Together with --filter-test, run filter on the message specified number'
+				' of times, both with tree-walking interpreter and compiled closures,'
+				' printing timings for each mode. Sound functions are disabled in this mode.'
+			' See also notification_filter.example for a sample filter file.')
+	group.add_argument('--no-filter-monitor',
+		action='store_false', dest='filter_monitor', default=True,
+		help='Do not use inotify (via Gio.FileMonitor) to reload --filter-file as soon as'
+			f' it is changed, checking its mtime every {poll_interval}s on new messages instead.')
+	group.add_argument('--filter-cache',
+		type=int, default=optz['filter_cache'], metavar='n',
+		help='Size of LRU cache for filtering results, keyed by message summary, body and app_name.'
+			' Filters which use impure functions like sound-play, or change global/closure'
+				' variables from procedures via (set ...), keeping state between calls, are never cached.'
+			' Cache is reset on filter reload, stats are returned by "Stats" dbus method.'
+			' Zero or negative value disables it (default: %(default)s).')
+	group.add_argument('--filter-parse-cache',
+		metavar='dir',
+		help='Directory to cache parsed and macro-expanded code of --filter-file in,'
+				' to speed up (re)loading it, e.g. on daemon start.'
+			' $XDG_CACHE_HOME in the path is expanded, with ~/.cache used if it is not set,'
+				' e.g. "$XDG_CACHE_HOME/notification-thing" can be used.'
+			' Cache is keyed by file contents, and is not used by default.')
+	group.add_argument('--filter-workers', type=int, default=0, metavar='n',
+		help='Run filters in specified number of worker processes, instead of daemon'
+				' main loop, so that slow or stuck filter rules will not block it.'
+			' Zero (default) disables this.')
+	group.add_argument('--filter-worker-timeout',
+		type=float, default=1.0, metavar='seconds',
+		help='Deadline for filtering each message in --filter-workers mode,'
+			' counted from when worker starts processing it, after which'
+			' stuck worker process is replaced by a new one (default: %(default)ss).')
+	group.add_argument('--filter-worker-fail-closed', action='store_true',
+		help='Drop messages which were not filtered within --filter-worker-timeout,'
+			' instead of displaying them (fail-open) by default.')
+	group.add_argument('--filter-corpus', metavar='path',
+		help='Do not start daemon, run all notifications from specified file ("-" - stdin)'
+				' through the filter, printing verdicts and properties set for each one,'
+				' and aggregate throughput/latency stats at the end. Sounds are disabled.'
+			' File can be JSON lines with notification fields (summary, body, hints, etc),'
+				' output of "notify-net-dump --json" or a --log-file log.')
+	group.add_argument('--filter-corpus-stats', action='store_true',
+		help='Only print aggregate stats with --filter-corpus, not results for each message.')
+	group.add_argument('--filter-profile', action='store_true',
+		help='Collect call counts, true-result counts and time spent in procedures'
+				' from each top-level filter form and every ~ / ~match call in them.'
+			' Report is printed with --filter-test, and returned by "FilterProfile"'
+				' dbus method otherwise. Not collected from --filter-workers processes.')
 	group.add_argument('--no-filter-sound',
 		action='store_false', dest='filter_sound', default=True,
 		help='Make sound calls in --filters-file scheme interpreter a no-op.'
@@ -600,6 +1286,15 @@ def main(argv=None):
 			' from --layout-anchor corner (default: %(default)s).')
 	group.add_argument('--layout-margin', default=3, type=int, metavar='px',
 		help='Margin between notifications, screen edges, and some misc stuff (default: %(default)spx).')
+	group.add_argument('--layout-max-windows', default=0, type=int, metavar='n',
+		help='Max number of notification windows to show at the same time,'
+				' with any extra ones hidden and collapsed into one "+N more" window'
+				' after these, until some earlier ones get closed. Default (0) - no limit.')
+	group.add_argument('--win-pool-size', default=0, type=int, metavar='n',
+		help='Number of hidden notification windows to pre-create'
+				' in advance during idle time, and re-use after closing,'
+				' to display new notifications faster, esp. in bursts, e.g. 3.'
+			' 0 (default) - create new window for each notification and destroy it when closed.')
 
 	group = parser.add_argument_group('Icon scaling options')
 	group.add_argument('--icon-width', '--img-w', type=int, metavar='px',
@@ -617,6 +1312,17 @@ def main(argv=None):
 				' that it only scales-down larger ones, not all icons.')
 	group.add_argument('--icon-size-min', '--img-min', metavar='WxH',
 		help='Same as --icon-size-max, but scales-up smaller images to a specified min size.')
+	group.add_argument('--icon-bench', nargs=2, metavar=('WxH', 'count'),
+		help='Do not start daemon, only run a benchmark of unpacking image-data'
+				' icon of specified size from dbus message and creating pixbuf from it,'
+				' specified number of times, both as an array of dbus.Byte objects'
+				' and with byte_arrays=True (as used in the daemon), printing timings.'
+			' Example: --icon-bench 512x512 100')
+	group.add_argument('--icon-cache-size', type=float, default=16, metavar='MiB',
+		help='Memory limit for the cache of loaded and scaled icon images,'
+				' to avoid re-loading and scaling same icon for every notification'
+				' (default: %(default)s MiB). 0 - disable cache.'
+			' Cache hit/miss counters are returned by Stats() dbus method.')
 
 	group = parser.add_argument_group('Text pango markup options')
 	group.add_argument('--markup-disable', action='store_true',
@@ -651,6 +1357,55 @@ def main(argv=None):
 		type=float, default=optz['tbf_dec'], metavar='value',
 		help='tbf_tick divider on successful grab from non-empty bucket,'
 			' wont lower multiplier below 1 (default: %(default)s)')
+	group.add_argument('--tbf-policy',
+		choices=sorted(core.flow_control_policies), default=optz['tbf_policy'],
+		help='Flow control algorithm to use for rate-limiting (default: %(default)s).'
+			' "token-bucket" is the classic one with adaptive --tbf-inc/--tbf-dec'
+				' rate adjustments, while "gcra" (generic cell rate algorithm) and'
+				' "sliding-log" (up to --tbf-size messages in any tbf_size * tbf_tick window)'
+				' only use --tbf-size and --tbf-tick, and have exact next-allowed times,'
+				' so that queued messages are flushed as soon as rate limit allows.'
+			' Can also be set as "policy" key in --tbf-source-settings.')
+	group.add_argument('--tbf-source-settings', metavar='yaml',
+		help='Optional yaml/json encoded settings for per-source token buckets,'
+				' which are used in addition to the global one, so that one noisy app or'
+				' remote host will be rate-limited without delaying notifications from others.'
+			' Keys are either "app" / "host" for all app_name / remote-host buckets,'
+				' or e.g. "app.firefox" / "host.myserver" for specific ones, with values being'
+				' dicts with policy, size, tick, max_delay, inc, dec keys (see --tbf-* options),'
+				' which override global values, or false value to disable per-source bucket.'
+			' Example: {app: {size: 2, tick: 30}, host: false, app.mpv: {inc: 4}}.'
+			' By default, per-source buckets are used with global parameters,'
+				' scaled by --tbf-source-share.')
+	group.add_argument('--tbf-source-share',
+		type=float, default=optz['tbf_source_share'], metavar='fraction',
+		help='Fraction of global bucket size and token rate to use for per-source'
+				' buckets by default, so that one noisy source can only use up this'
+				' share of global rate limit, leaving the rest for others (default: %(default)s).'
+			' Bucket size is rounded down, but is at least 1 token.'
+			' Value of 1 makes per-source buckets same as the global one.')
+	group.add_argument('--tbf-cost-weights', metavar='yaml',
+		help='Optional yaml/json encoded weights for calculating rate-limiting token'
+				' cost of each notification, so that bursts of large ones are throttled harder.'
+			' Cost is "base" value (default: 1) plus "chars" per 1000 chars of summary/body,'
+				' "lines" per body line, "markup" for messages with markup and'
+				' "icon_px" per 100x100 pixels of image-data icon.'
+			' Example: {chars: 1, lines: 0.1, icon_px: 0.2}.'
+			' Comparison of token spend to actual time spent creating windows is available'
+				' from "Stats" dbus method (render.* keys). Default is one token per message.')
+	group.add_argument('--tbf-simulate', metavar='path',
+		help='Do not start daemon, replay timestamped notifications from specified file'
+				' ("-" - stdin) through filters, rate-limiting and queueing logic with a virtual'
+				' clock, and print stats on resulting popups per minute, queueing delays,'
+				' feed sizes and dropped messages, e.g. to compare different --tbf-* settings.'
+			' File format is same as for --filter-corpus (with "ts" for each message),'
+				' and can also have plug/fullscreen state changes as JSON lines,'
+				' e.g. {"ts": 1700000000, "plug": true}.')
+	group.add_argument('--tbf-source-max',
+		type=int, default=optz['tbf_source_max'], metavar='n',
+		help='Max number of per-source token buckets to keep,'
+				' dropping least-recently-used ones on overflow (default: %(default)s).'
+			' Zero or negative value disables per-source rate-limiting.')
 	group.add_argument('--feed-icon',
 		type=float, default=optz['feed_icon'], metavar='icon',
 		help='Icon name/path to use for aggregated ("feed") notification.'
@@ -680,6 +1435,23 @@ def main(argv=None):
 	group.add_argument('--net-settings', metavar='yaml',
 		help='Optional yaml/json encoded settings'
 			' for PubSub class init (e.g. hostname, buffer, reconnect_max, etc).')
+	group.add_argument('--net-ingress-burst',
+		type=int, metavar='count', default=0,
+		help='Max burst of messages to accept from each remote host,'
+				' with any over that limit dropped without decoding them, and reported as'
+				' a single summary message, if any. Disabled by default (0 - no limit),'
+				' set to e.g. 20 to enable, with one more message per --net-ingress-tick.'
+			' Remote host is identified by hostname in a header of its messages.')
+	group.add_argument('--net-ingress-tick',
+		type=float, metavar='seconds', default=1.0,
+		help='Interval between messages from each remote host to'
+			' allow after --net-ingress-burst is exhausted (default: %(default)ss).')
+	group.add_argument('--net-drain-budget',
+		type=int, metavar='count', default=50,
+		help='Max number of remote messages to process in one go,'
+				' handling other events before processing more, so that'
+				' flood from network cannot stall everything else (default: %(default)s).'
+			' 0 - process all queued messages at once.')
 
 	group = parser.add_argument_group('Message logging options')
 	group.add_argument('--log-file', metavar='file',
@@ -715,20 +1487,56 @@ def main(argv=None):
 	log = logging.getLogger('daemon')
 
 	optz.filter_file = os.path.expanduser(optz.filter_file)
+	if optz.queue_spool: optz.queue_spool = os.path.expanduser(optz.queue_spool)
+	if optz.state_checkpoint: optz.state_checkpoint = os.path.expanduser(optz.state_checkpoint)
+	if optz.filter_dir: optz.filter_dir = os.path.expanduser(optz.filter_dir)
+	if optz.filter_parse_cache:
+		optz.filter_parse_cache = os.path.expanduser(os.path.expandvars(
+			optz.filter_parse_cache.replace( '$XDG_CACHE_HOME',
+				os.environ.get('XDG_CACHE_HOME') or '~/.cache' ) ))
 	core.Notification.default_timeout = optz.popup_timeout
+	if isinstance(optz.coalesce_key, str):
+		optz.coalesce_key = list(filter(None, map(str.strip, optz.coalesce_key.split(','))))
+	if set(optz.coalesce_key or list()).difference(['summary', 'body', 'app_name']):
+		parser.error(f'Unrecognized --coalesce-key field(s): {optz.coalesce_key}')
+	for k in 'tbf_source_settings', 'tbf_cost_weights', 'queue_app_weights':
+		v = getattr(optz, k)
+		if v and not isinstance(v, cs.abc.Mapping):
+			import yaml
+			setattr(optz, k, yaml.safe_load(v))
+	if optz.filter_bench or optz.filter_corpus or optz.tbf_simulate: optz.filter_sound = None
 	if optz.filter_sound:
 		optz.filter_sound = core.get_sound_env(
 			force_sync=optz.filter_test, trap_errors=not (optz.filter_test or optz.debug) )
 
+	if optz.filter_corpus:
+		return filter_corpus( optz.filter_file,
+			NotificationCorpus(optz.filter_corpus), optz.filter_dir,
+			verbose=not optz.filter_corpus_stats, markup=not optz.markup_disable,
+			cache_size=optz.filter_cache, parse_cache_dir=optz.filter_parse_cache )
+
+	if optz.tbf_simulate:
+		optz.filter_workers = 0
+		return rate_simulate(NotificationCorpus(optz.tbf_simulate, events=True))
+
 	if optz.filter_test:
-		note, func = dict(), core.get_filter(optz.filter_file, optz.filter_sound)
+		if optz.filter_bench:
+			return filter_bench(optz.filter_file, *optz.filter_test, optz.filter_bench)
+		note, func = dict(), core.get_filter(
+			optz.filter_file, optz.filter_sound, profile=optz.filter_profile )
 		filtering_result = func(*optz.filter_test, note=note)
 		msg_repr = 'Message - summary: {!r}, body: {!r}'.format(*optz.filter_test)
 		print('{}\nFiltering result: {} ({})'.format( msg_repr,
 			filtering_result, 'will pass' if filtering_result else "won't pass" ))
 		if note: print(f'Added properties: {note}')
+		if func.profile: print('Filter profile:\n  {}'.format('\n  '.join(func.profile.report())))
 		return
 
+	if optz.icon_bench:
+		try: (w, h), count = map(int, optz.icon_bench[0].split('x')), int(optz.icon_bench[1])
+		except ValueError: parser.error(f'Invalid --icon-bench value: {optz.icon_bench!r}')
+		return icon_bench(w, h, count)
+
 	optz.icon_scale = dict()
 	if optz.icon_width or optz.icon_height:
 		optz.icon_scale['fixed'] = optz.icon_width, optz.icon_height
@@ -1,7 +1,7 @@
 import itertools as it, operator as op, functools as ft
 from xml.sax.saxutils import escape as xml_escape
 import html.parser, html.entities
-import os, re, collections as cs, urllib.request as ulr
+import os, re, hashlib, collections as cs, urllib.request as ulr
 
 import gi
 gi.require_version('Gtk', '3.0')
@@ -9,6 +9,7 @@ gi.require_version('Gdk', '3.0')
 from gi.repository import Gtk, Gdk, GdkPixbuf, GLib, Pango
 
 from . import core
+from .scheduler import Scheduler
 
 import logging
 log = logging.getLogger(__name__)
@@ -33,9 +34,20 @@ class NotificationDisplay:
 	'''Interface to display notification stack.
 		Should have "display(note, cb_dismiss=None) -> nid(UInt32, >0)", "close(nid)"
 			methods and NoWindowError(nid) exception, raised on erroneous nid's in close().
+		Up to win_pool hidden pre-realized windows are kept to quickly display notes in,
+			refilled from idle callbacks, with closed windows returned there to be reused.
+		Scaled icon pixbufs are cached in an LRU cache of up to icon_cache bytes,
+			keyed by file path + mtime, theme icon name + size or image-data hash.
+		Raw image-data is used for pixbuf via GLib.Bytes, without copying it in python.
+		Layout uses window sizes from their "configure-event" and cached screen geometry,
+			only moving windows which positions change, with up to layout_max of these
+			shown at the same time, and a "+N more" window for the rest, if there are more.
+		display(cb_hidden=func) is called as func(nid, hidden) when window gets hidden
+			that way or shown again, e.g. to not have its timeout run out while not visible.
 		Current implementation based on notipy: git://github.com/the-isz/notipy.git'''
 
-	window = cs.namedtuple('Window', 'gobj event_boxes')
+	window = cs.namedtuple( 'Window',
+		'gobj event_boxes summary body markup icon urgency handlers' )
 	base_css = b'''
 		#notification { background: transparent; }
 		#notification #frame { background-color: #d4ded8; padding: 3px; }
@@ -59,17 +71,26 @@ class NotificationDisplay:
 
 	def __init__( self, layout_margin,
 			layout_anchor, layout_direction, icon_scale=dict(),
-			markup_default=False, markup_warn=False, markup_strip=False ):
+			markup_default=False, markup_warn=False,
+			markup_strip=False, scheduler=None, win_pool=0, layout_max=0, icon_cache=0 ):
 		self.margins = dict(it.chain.from_iterable(map(
 			lambda ax: ( (2**ax, layout_margin),
 				(-2**ax, layout_margin) ), range(2) )))
 		self.layout_anchor = layout_anchor
 		self.layout_direction = layout_direction
+		self.layout_max = layout_max
 		self.icon_scale = icon_scale
+		self.icon_cache = None if not icon_cache else core.LRUCache(
+			icon_cache, weigh=lambda pixbuf: pixbuf.get_rowstride() * pixbuf.get_height() )
 		self.markup_default = markup_default
 		self.markup_warn, self.markup_strip = markup_warn, markup_strip
+		self.scheduler = scheduler or Scheduler()
+		self._layout_timer = self.scheduler.timer(self._update_layout)
 
-		self._windows = dict()
+		self._windows, self._win_sizes, self._win_pos = dict(), dict(), dict()
+		self._win_hidden, self._layout_base, self._overflow = set(), None, None
+		self._win_cb_hidden = dict()
+		self.win_pool_size, self._win_pool, self._win_pool_refill_id = win_pool, list(), None
 
 		self._default_style = self._get_default_css()
 		screen = Gdk.Screen.get_default()
@@ -77,6 +98,10 @@ class NotificationDisplay:
 		Gtk.StyleContext.add_provider_for_screen(
 			screen, self._default_style,
 			Gtk.STYLE_PROVIDER_PRIORITY_APPLICATION )
+		for ev in 'monitors-changed', 'size-changed': screen.connect(ev, self._layout_reset)
+		if self.icon_cache is not None:
+			Gtk.IconTheme.get_default().connect('changed', lambda theme: self.icon_cache.clear())
+		self._win_pool_refill()
 
 
 	def _pango_markup_parse(self, text, _err_mark='[TN82u8] '):
@@ -117,37 +142,130 @@ class NotificationDisplay:
 		return css
 
 
-	def _update_layout(self):
-		# Get the coordinates of the "anchor" corner (screen corner +/- margins)
+	def _update_layout_delayed(self):
+		'''Schedule _update_layout() call from the main loop,
+			so that any number of "configure-event" signals for windows
+			between main loop iterations will only result in one layout update.'''
+		if not self._layout_timer.active: self.scheduler.schedule(self._layout_timer, 0)
+
+	def _layout_reset(self, screen=None):
+		'Drop cached screen geometry and window positions, e.g. on monitor changes.'
+		self._layout_base = None
+		self._win_pos.clear()
+		self._update_layout_delayed()
+
+	def _get_layout_base(self):
+		'Returns coordinates of the "anchor" corner (screen corner +/- margins).'
+		if not self._layout_base:
+			self._layout_base = tuple(map(
+				lambda ax, gdk_dim=('width', 'height'):\
+					(getattr(Gdk.Screen, gdk_dim[ax])() - self.margins[2**ax])\
+						if 2**ax & self.layout_anchor else self.margins[-2**ax], range(2) ))
+		return self._layout_base
+
+	def _layout_pos(self, base, size):
+		'Returns window position for its size and base corner, and base for the next one.'
+		pos = tuple(map(lambda ax: int( base[ax] - ( size[ax]
+			if 2**ax & self.layout_anchor else 0 ) ), range(2)))
+		margin = self.margins[(2 * ( (2**self.layout_direction)
+			& self.layout_anchor ) / 2**self.layout_direction - 1) * 2**self.layout_direction]
 		base = tuple(map(
-			lambda ax, gdk_dim=('width', 'height'):\
-				(getattr(Gdk.Screen, gdk_dim[ax])() - self.margins[2**ax])\
-					if 2**ax & self.layout_anchor else self.margins[-2**ax], range(2) ))
+			lambda ax: base[ax] if self.layout_direction != ax else\
+				base[ax] + (margin + size[ax])\
+					* (2 * (2**ax ^ (2**ax & self.layout_anchor)) / 2**ax - 1), range(2) ))
+		return pos, base
+
+	def _update_layout(self):
 		# Iterate over windows in order, placing each one starting from a "base" corner
-		for win in map(op.attrgetter('gobj'), self._windows.values()):
-			win.move(*map(lambda ax: base[ax] - ( win.get_size()[ax]
-				if 2**ax & self.layout_anchor else 0 ), range(2)))
-			margin = self.margins[(2 * ( (2**self.layout_direction)
-				& self.layout_anchor ) / 2**self.layout_direction - 1) * 2**self.layout_direction]
-			base = tuple(map(
-				lambda ax: base[ax] if self.layout_direction != ax else\
-					base[ax] + (margin + win.get_size()[ax])\
-						* (2 * (2**ax ^ (2**ax & self.layout_anchor)) / 2**ax - 1), range(2) ))
+		# Only window sizes cached from "configure-event" are used here,
+		#  so that there are no X round-trips, and only windows that need it are moved
+		base, wins = self._get_layout_base(), list(self._windows.items())
+		overflow = max(0, len(wins) - self.layout_max) if self.layout_max else 0
+		if overflow: wins, wins_hidden = wins[:self.layout_max], wins[self.layout_max:]
+		else: wins_hidden = list()
+		for nid, win in wins:
+			size = self._win_sizes.get(nid) or win.gobj.get_size()
+			pos, base = self._layout_pos(base, size)
+			if nid in self._win_hidden:
+				self._win_hidden.remove(nid)
+				win.gobj.show()
+				if cb := self._win_cb_hidden.get(nid): cb(nid, False)
+			elif self._win_pos.get(nid) == pos: continue
+			win.gobj.move(*pos)
+			self._win_pos[nid] = pos
+		for nid, win in wins_hidden:
+			if nid in self._win_hidden: continue
+			win.gobj.hide()
+			self._win_hidden.add(nid)
+			self._win_pos.pop(nid, None)
+			if cb := self._win_cb_hidden.get(nid): cb(nid, True)
+		self._update_overflow(overflow, base)
+
+	def _update_overflow(self, count, base):
+		'Shows "+N more" window for N notification windows over layout_max at base.'
+		if not count:
+			if self._overflow: self._overflow[0].hide()
+			return
+		if not self._overflow:
+			win, label = Gtk.Window(name='notification', type=Gtk.WindowType.POPUP), Gtk.Label(name='summary')
+			self._set_visual(win)
+			frame = Gtk.Box(name='frame')
+			frame.pack_start(label, True, True, 0)
+			win.add(frame)
+			self._overflow = win, label
+		win, label = self._overflow
+		label.set_text(f'+{count} more')
+		win.show_all()
+		pos, base = self._layout_pos(base, win.get_size())
+		win.move(*pos)
+
 
+	def _get_icon_path(self, icon):
+		icon_path = os.path.expanduser(ulr.url2pathname(icon))
+		if icon_path.startswith('file://'): icon_path = icon_path[7:]
+		return icon_path
+
+	def _icon_repr(self, icon):
+		if icon is None or isinstance(icon, str): return icon
+		return '<image-data {}x{}, {:,d} B>'.format(*icon[:2], len(icon[-1]))
+
+	def _get_icon_size(self): return any(self.icon_scale.get('fixed', list())) or 32
+
+	def _get_icon_cache_key(self, icon):
+		'Returns icon_cache key for icon path, name or image-data struct, and icon_scale.'
+		scale = tuple(sorted((k, tuple(v)) for k, v in self.icon_scale.items()))
+		if isinstance(icon, str):
+			try: return 'file', icon, os.stat(self._get_icon_path(icon)).st_mtime_ns, scale
+			except OSError: pass
+			return ( 'theme', Gtk.Settings.get_default().props.gtk_icon_theme_name,
+				icon, self._get_icon_size(), scale )
+		digest = hashlib.blake2b(icon[-1], digest_size=16).digest()
+		return ('data', *map(int, icon[:-1]), digest, scale)
 
 	def _get_icon(self, icon, remote=False):
+		'''Returns scaled GdkPixbuf for icon path, name or image-data struct, or None.
+			Same pixbuf object is returned for same icon from icon_cache, if enabled.'''
+		if icon is None: return
+		if not isinstance(icon, str): icon = *icon[:-1], core.image_data_bytes(icon[-1])
+		if self.icon_cache is None: return self._load_icon(icon, remote)
+		key = self._get_icon_cache_key(icon)
+		if (pixbuf := self.icon_cache.get(key)) is None:
+			pixbuf = self._load_icon(icon, remote)
+			if pixbuf: self.icon_cache[key] = pixbuf
+		return pixbuf
+
+	def _load_icon(self, icon, remote=False):
 		widget_icon = None
 
 		if icon is not None:
 			if isinstance(icon, str):
-				icon_path = os.path.expanduser(ulr.url2pathname(icon))
-				if icon_path.startswith('file://'): icon_path = icon_path[7:]
+				icon_path = self._get_icon_path(icon)
 				if os.path.isfile(icon_path):
 					widget_icon = GdkPixbuf.Pixbuf.new_from_file(icon_path)
 				else:
 					# Available names: Gtk.IconTheme.get_default().list_icons(None)
 					theme = Gtk.IconTheme.get_default()
-					icon_size = any(self.icon_scale.get('fixed', list())) or 32
+					icon_size = self._get_icon_size()
 					widget_icon = theme.lookup_icon(
 						icon, icon_size, Gtk.IconLookupFlags.USE_BUILTIN )
 					if widget_icon: widget_icon = widget_icon.load_icon()
@@ -159,11 +277,10 @@ class NotificationDisplay:
 								' does not have that one), ignoring it: %r', core.format_trunc(icon) )
 			else:
 				w, h, rowstride, has_alpha, bits_per_sample, channels, data = icon
-				data = bytes(bytearray(data))
-				widget_icon = GdkPixbuf.Pixbuf.new_from_data(
-					data, GdkPixbuf.Colorspace.RGB, bool(has_alpha),
+				widget_icon = GdkPixbuf.Pixbuf.new_from_bytes(
+					GLib.Bytes.new(core.image_data_bytes(data)),
+					GdkPixbuf.Colorspace.RGB, bool(has_alpha),
 					int(bits_per_sample), int(w), int(h), int(rowstride) )
-				widget_icon._data = data # must be preserved from gc
 
 		if widget_icon:
 			if any(it.chain.from_iterable(self.icon_scale.values())): # scale icon
@@ -183,8 +300,6 @@ class NotificationDisplay:
 						' %.3f: %dx%d -> %dx%d', ['up', 'down'][scale_down], k, scale, w, h, box_w, box_h )
 					widget_icon = widget_icon.scale_simple(box_w, box_h, GdkPixbuf.InterpType.BILINEAR)
 					if k == 'fixed': break # no need to apply min/max after that
-			widget_icon, pixbuf = Gtk.Image(), widget_icon
-			widget_icon.set_from_pixbuf(pixbuf)
 
 		return widget_icon
 
@@ -193,12 +308,31 @@ class NotificationDisplay:
 		visual = win.get_screen().get_rgba_visual()
 		if visual: win.set_visual(visual)
 
-	def _create_win( self, summary, body,
-			icon=None, urgency_label=None, markup=False, remote=None ):
-		log.debug( 'Creating window with parameters: %s',
-			core.repr_trunc_rec(dict( summary=summary, body=body,
-				icon=icon, urgency=urgency_label, markup=markup )) )
-
+	def _win_pool_refill(self):
+		'''Schedules creating one hidden window for the pool per idle
+			callback, until there are win_pool_size of these, so that it won't delay
+			handling any other events or messages, and won't be done during bursts of them.'''
+		if self._win_pool_refill_id is None:
+			if len(self._win_pool) < self.win_pool_size:
+				self._win_pool_refill_id = GLib.idle_add(
+					self._win_pool_refill_cb, priority=GLib.PRIORITY_LOW )
+
+	def _win_pool_refill_cb(self):
+		if len(self._win_pool) >= self.win_pool_size:
+			self._win_pool_refill_id = None
+			return False
+		try:
+			win = self._win_skeleton()
+			win.gobj.realize()
+		except:
+			log.exception('Failed to create window for the pool')
+			self._win_pool_refill_id = None
+			return False
+		self._win_pool.append(win)
+		return True
+
+	def _win_skeleton(self):
+		'Returns window with all widgets in it, but without any contents, not shown.'
 		win = Gtk.Window(name='notification', type=Gtk.WindowType.POPUP)
 		win.set_default_size(400, 20)
 		win.connect('screen-changed', self._set_visual)
@@ -208,36 +342,22 @@ class NotificationDisplay:
 		frame = Gtk.Box(name='frame')
 		win.add(frame)
 
-		try: widget_icon = self._get_icon(icon, remote=remote)
-		except Exception: # Gdk may raise errors for some images/formats
-			log.exception('Failed to set notification icon')
-			widget_icon = None
-
+		# Icon and urgency widgets are always created, but hidden/transparent
+		#  if unused, so that these can be set or changed later in update_note()
 		box_margin = 3
 		v_box = Gtk.VBox(spacing=box_margin, expand=False)
-		if widget_icon is not None:
-			h_box = Gtk.HBox(spacing=box_margin * 2)
-			frame.pack_start(h_box, True, True, 0)
-			h_box.pack_start(widget_icon, False, False, 0)
-			h_box.pack_start(v_box, True, True, 0)
-			ev_boxes.append(h_box)
-		else: frame.pack_start(v_box, True, True, 0)
+		h_box = Gtk.HBox(spacing=box_margin * 2)
+		frame.pack_start(h_box, True, True, 0)
+		widget_icon = Gtk.Image()
+		widget_icon.set_no_show_all(True)
+		h_box.pack_start(widget_icon, False, False, 0)
+		h_box.pack_start(v_box, True, True, 0)
+		ev_boxes.append(h_box)
 
 		widget_summary = Gtk.Label(name='summary')
-
-		# Sanitize tags through pango first, so set_markup won't produce empty label
-		markup_summary = markup
-		if markup_summary:
-			markup_summary, text = self._pango_markup_parse(summary)
-			if markup_summary: widget_summary.set_markup(summary)
-			else: summary = text
-		if not markup_summary: widget_summary.set_text(summary)
-
 		widget_summary.set_alignment(0, 0)
-		if urgency_label:
-			summary_box = Gtk.EventBox(name=urgency_label)
-			summary_box.add(widget_summary)
-		else: summary_box = widget_summary
+		summary_box = Gtk.EventBox()
+		summary_box.add(widget_summary)
 		v_box.pack_start(summary_box, False, False, 0)
 		ev_boxes.append(summary_box)
 
@@ -246,30 +366,91 @@ class NotificationDisplay:
 		widget_body = Gtk.TextView( name='body',
 			wrap_mode=Gtk.WrapMode.WORD_CHAR,
 			cursor_visible=False, editable=False )
-		widget_body_buffer = widget_body.get_buffer()
+		v_box.pack_start(widget_body, True, True, 0)
+		ev_boxes.append(widget_body)
+
+		for eb in ev_boxes:
+			eb.add_events(
+				Gdk.EventMask.BUTTON_PRESS_MASK
+				| Gdk.EventMask.POINTER_MOTION_MASK
+				| Gdk.EventMask.LEAVE_NOTIFY_MASK )
+		return self.window( win, ev_boxes,
+			widget_summary, widget_body, False, widget_icon, summary_box, list() )
+
+	def _create_win( self, summary, body,
+			icon=None, urgency_label=None, markup=False, remote=None ):
+		log.debug( 'Creating window with parameters: %s',
+			core.repr_trunc_rec(dict( summary=summary, body=body,
+				icon=self._icon_repr(icon), urgency=urgency_label, markup=markup )) )
+		if self._win_pool: win = self._win_pool.pop()
+		else: win = self._win_skeleton()
+		self._win_pool_refill()
+
+		win = win._replace(markup=markup)
+		self._set_icon(win.icon, icon, remote)
+		self._set_urgency(win.urgency, urgency_label)
+		self._set_text(win.summary, win.body, summary, body, markup)
+
+		# Make sure the window is initially drawn off-screen, because it can't be
+		#  placed properly until it's size is known, and it's size is unknown until it's
+		#  actually handled by window manager and then drawn by X
+		# Proper placement is done on update_layout() call
+		win.gobj.move(-2000, -2000)
+
+		win.gobj.show_all()
+		return win
+
+	def _recycle_win(self, win):
+		'''Hides window, clearing its contents and signal handlers,
+			and returns it to the pool, or destroys it if pool is full.'''
+		for obj, handler in win.handlers: obj.disconnect(handler)
+		win.handlers.clear()
+		if len(self._win_pool) >= self.win_pool_size:
+			win.gobj.hide(), win.gobj.destroy()
+			return
+		win.gobj.hide()
+		self._set_icon(win.icon, None)
+		self._set_text(win.summary, win.body, '', '')
+		win.gobj.resize(400, 20) # shrink to fit new contents
+		self._win_pool.append(win)
+
+	def _set_icon(self, widget_icon, icon, remote=False):
+		try: pixbuf = self._get_icon(icon, remote=remote)
+		except Exception: # Gdk may raise errors for some images/formats
+			log.exception('Failed to set notification icon')
+			pixbuf = None
+		if pixbuf is None:
+			widget_icon.clear()
+			widget_icon.hide()
+		else:
+			widget_icon.set_from_pixbuf(pixbuf)
+			widget_icon.show()
+
+	def _set_urgency(self, summary_box, urgency_label):
+		summary_box.set_name(urgency_label or 'summary-box')
+		summary_box.set_visible_window(bool(urgency_label)) # no background otherwise
+
+	def _set_text(self, widget_summary, widget_body, summary, body, markup=False):
+		# Sanitize tags through pango first, so set_markup won't produce empty label
+		markup_summary = markup
+		if markup_summary:
+			markup_summary, text = self._pango_markup_parse(summary)
+			if markup_summary: widget_summary.set_markup(summary)
+			else: summary = text
+		if not markup_summary: widget_summary.set_text(summary)
 
 		# Same as with summary - sanitize tags through pango first
+		widget_body_buffer = widget_body.get_buffer()
 		markup_body = markup
 		if markup_body:
 			markup_body, text = self._pango_markup_parse(body)
 			if markup_body:
+				widget_body_buffer.set_text('')
 				cursor = widget_body_buffer.get_end_iter()
 				widget_body_buffer.insert_markup(cursor, body, -1)
 			else: body = text
 		if not markup_body: widget_body_buffer.set_text(body)
 
-		v_box.pack_start(widget_body, True, True, 0)
-		ev_boxes.append(widget_body)
-
-		# Make sure the window is initially drawn off-screen, because it can't be
-		#  placed properly until it's size is known, and it's size is unknown until it's
-		#  actually handled by window manager and then drawn by X
-		# Proper placement is done on update_layout() call
-		win.move(-2000, -2000)
-
-		win.show_all()
-		return self.window(win, ev_boxes)
-
 
 	def get_note_markup(self, note):
 		return note.hints.get('x-nt-markup', self.markup_default)
@@ -283,64 +464,99 @@ class NotificationDisplay:
 		return summary, body
 
 
-	def display(self, note, cb_dismiss=None, cb_hover=None, cb_leave=None):
+	def _note_params(self, note):
+		'Returns (icon, urgency_label, markup, remote) parameters for note window.'
+		# Priorities for icon sources:
+		#  image{-,_}data: hint. raw image data structure of signature (iiibiiay)
+		#  image{-,_}path: hint. either an URI (file://...) or a name in a f.o-compliant icon theme
+		#  app_icon: parameter. same as image-path
+		#  icon_data: hint. same as image-data
+		# image_* is a deprecated hints from 1.1 spec, 1.2 is preferred
+		#  (don't seem to be even mentioned in 1.2 spec icon priorities section)
+		hints = note.hints.copy()
+		k = '__app_icon' # to avoid clobbering anything
+		hints[k] = note.icon
+		for k in 'image-data', 'image_data',\
+				'image-path', 'image_path', k, 'icon_data':
+			image = hints.get(k)
+			if image:
+				log.debug('Got icon image from hint: %s', k)
+				break
+
+		urgency = note.hints.get('urgency')
+		if urgency is not None: urgency = core.urgency_levels.by_id(int(urgency))
+		return image, urgency, self.get_note_markup(note), note.hints.get('x-nt-from-remote')
+
+	def display(self, note, cb_dismiss=None, cb_hover=None, cb_leave=None, cb_hidden=None):
 		try:
-			# Priorities for icon sources:
-			#  image{-,_}data: hint. raw image data structure of signature (iiibiiay)
-			#  image{-,_}path: hint. either an URI (file://...) or a name in a f.o-compliant icon theme
-			#  app_icon: parameter. same as image-path
-			#  icon_data: hint. same as image-data
-			# image_* is a deprecated hints from 1.1 spec, 1.2 is preferred
-			#  (don't seem to be even mentioned in 1.2 spec icon priorities section)
-			hints = note.hints.copy()
-			k = '__app_icon' # to avoid clobbering anything
-			hints[k] = note.icon
-			for k in 'image-data', 'image_data',\
-					'image-path', 'image_path', k, 'icon_data':
-				image = hints.get(k)
-				if image:
-					log.debug('Got icon image from hint: %s', k)
-					break
-
-			urgency = note.hints.get('urgency')
-			if urgency is not None: urgency = core.urgency_levels.by_id(int(urgency))
-			markup = self.get_note_markup(note)
-
-			win = self._create_win( note.summary, note.body,
-				image, urgency, markup=markup, remote=note.hints.get('x-nt-from-remote') )
+			image, urgency, markup, remote = self._note_params(note)
+			win = self._create_win(note.summary, note.body, image, urgency, markup=markup, remote=remote)
 
+			connect = lambda obj, *args: win.handlers.append((obj, obj.connect(*args)))
 			for eb in win.event_boxes:
-				eb.add_events(
-					Gdk.EventMask.BUTTON_PRESS_MASK
-					| Gdk.EventMask.POINTER_MOTION_MASK
-					| Gdk.EventMask.LEAVE_NOTIFY_MASK )
 				for ev,cb in [
 						('button-press-event', cb_dismiss),
 						('motion-notify-event', cb_hover),
 						('leave-notify-event', cb_leave) ]:
-					if cb: eb.connect(ev, lambda w,ev,cb,nid: cb(nid), cb, note.id)
+					if cb: connect(eb, ev, lambda w,ev,cb,nid: cb(nid), cb, note.id)
 			if cb_dismiss and win.event_boxes:
 				# Connect only to window object (or first eventbox in the list)
-				win.event_boxes[0].connect( 'destroy',
+				connect( win.event_boxes[0], 'destroy',
 					lambda w,cb,nid: cb(nid), cb_dismiss, note.id )
 
 			# update_layout() *must* be delayed until window "configure-event", because
 			#  actual window size is unknown until it's resized by window manager and drawn by X
 			# See the list of caveats here:
 			#  http://developer.gnome.org/gtk3/unstable/GtkWindow.html#gtk-window-get-size
-			win.gobj.connect('configure-event', lambda w,void: self._update_layout())
+			connect( win.gobj, 'configure-event',
+				lambda w,ev,nid: self._win_configure(nid, ev), note.id )
 			self._windows[note.id] = win
+			if cb_hidden: self._win_cb_hidden[note.id] = cb_hidden
 
 		except: log.exception('Failed to create notification window')
 
 
 	class NoWindowError(Exception): pass
 
+	def _win_configure(self, nid, ev):
+		'Schedules layout update only if window size changes, and not for just moving it.'
+		if nid not in self._windows: return
+		size = ev.width, ev.height
+		if self._win_sizes.get(nid) == size: return
+		self._win_sizes[nid] = size
+		self._update_layout_delayed()
+
 	def _close(self, nid):
-		try: win = self._windows.pop(nid).gobj
+		try: win = self._windows.pop(nid)
 		except KeyError: raise self.NoWindowError(nid)
-		win.hide(), win.destroy()
+		self._win_sizes.pop(nid, None)
+		self._win_pos.pop(nid, None)
+		self._win_hidden.discard(nid)
+		self._win_cb_hidden.pop(nid, None)
+		self._recycle_win(win)
 
 	def close(self, nid):
 		self._close(nid)
-		self._update_layout()
+		self._update_layout_delayed()
+
+	def update(self, nid, summary, body):
+		'''Update summary/body text of displayed window in-place.
+			Layout gets updated from "configure-event" if window size changes.'''
+		try: win = self._windows[nid]
+		except KeyError: raise self.NoWindowError(nid)
+		self._set_text(win.summary, win.body, summary, body, win.markup)
+
+	def update_note(self, nid, note):
+		'''Update displayed window in-place with all contents of
+				a new note - text, icon and urgency style, e.g. for replaces_id.
+			Same as with update(), layout is only updated if window size changes.'''
+		try: win = self._windows[nid]
+		except KeyError: raise self.NoWindowError(nid)
+		image, urgency, markup, remote = self._note_params(note)
+		log.debug( 'Updating window (id: %s) with parameters: %s', nid,
+			core.repr_trunc_rec(dict( summary=note.summary,
+				body=note.body, icon=self._icon_repr(image), urgency=urgency, markup=markup )) )
+		if markup != win.markup: self._windows[nid] = win = win._replace(markup=markup)
+		self._set_text(win.summary, win.body, note.summary, note.body, markup)
+		self._set_icon(win.icon, image, remote)
+		self._set_urgency(win.urgency, urgency)
@@ -0,0 +1,163 @@
+import signal, traceback, itertools as it, collections as cs, multiprocessing as mp
+
+from gi.repository import GLib
+
+from . import core
+from .scheduler import Scheduler
+
+import logging
+log = logging.getLogger(__name__)
+
+
+_worker_filter = None
+
+def _worker_init(path, dir_path=None, sound=False, cache_size=0, parse_cache_dir=None):
+	global _worker_filter
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
+	core._scheme_init = False # in case it was inherited from forkserver process
+	sound_env = core.get_sound_env(trap_errors=True) if sound else None
+	_worker_filter = core.get_filter_index( path, dir_path, sound_env=sound_env,
+		cache_size=cache_size, parse_cache_dir=parse_cache_dir )
+
+def _worker_run(summary, body, app_name, hints):
+	'''Returns (verdict, props, error) tuple, with props as a dict of note updates.
+		hints should only have ones used for dispatch in FilterIndex, as simple types.'''
+	note = dict(app_name=app_name, hints=hints.copy())
+	try: result = bool(_worker_filter(summary, body, note))
+	except: return True, None, traceback.format_exc()
+	props = dict( (k, v) for k, v in note.items()
+		if k not in ('app_name', 'hints') or (k == 'app_name' and v != app_name) )
+	props_hints = dict((k, v) for k, v in note['hints'].items() if hints.get(k) != v)
+	if props_hints: props['hints'] = props_hints
+	return result, props, None
+
+def _worker_main(conn, init_args):
+	'Runs filter on (summary, body, app_name, hints) tuples from conn, sending results back.'
+	_worker_init(*init_args)
+	while True:
+		try: task = conn.recv()
+		except EOFError: break
+		conn.send(_worker_run(*task))
+
+
+class FilterWorker:
+	__slots__ = 'proc', 'conn', 'watch', 'timer', 'task_id'
+
+	def __init__(self, proc, conn):
+		self.proc, self.conn = proc, conn
+		self.watch = self.timer = self.task_id = None
+
+	def __repr__(self): return f'<FilterWorker[{self.proc.pid}] task={self.task_id}>'
+
+
+class FilterWorkers:
+	'''Pool of worker processes to run notification filters in,
+			so that slow or stuck filters won't block the GLib main loop.
+		Messages are queued here and sent to idle workers one at a time, each over its own pipe,
+			so that deadline (timeout, seconds) only starts when worker gets the message.
+		After deadline, callback gets fail_open value as a verdict, and stuck worker
+			is killed and replaced with a new one, without affecting any other messages.
+		Workers are started via "forkserver" multiprocessing context,
+			as forking daemon process with GLib/dbus threads in it is not safe.
+		Callbacks are always called from the GLib main loop.'''
+
+	def __init__( self, path, dir_path=None, workers=2, timeout=1.0, fail_open=True,
+			sound=False, cache_size=0, parse_cache_dir=None, scheduler=None ):
+		self.path, self.dir_path, self.workers, self.timeout = path, dir_path, workers, timeout
+		self.fail_open, self.sound = fail_open, sound
+		self.cache_size, self.parse_cache_dir = cache_size, parse_cache_dir
+		self.scheduler = scheduler or Scheduler()
+		self._ctx, self._workers = mp.get_context('forkserver'), list()
+		self._pending, self._queue, self._task_ids = dict(), cs.deque(), it.count(1)
+		self.restart()
+
+	def restart(self):
+		'''(Re)Start worker processes, e.g. to reload filter.
+			Messages that were being filtered by old workers are re-queued.'''
+		self._queue.extendleft(reversed(list(
+			w.task_id for w in self._workers if w.task_id is not None )))
+		self.close()
+		log.debug( 'Starting filter workers (count: %s, queued: %s)',
+			self.workers, len(self._queue) )
+		self._workers = list(self._worker_start() for n in range(self.workers))
+		self._dispatch()
+
+	def close(self):
+		for w in self._workers: self._worker_stop(w)
+		self._workers.clear()
+
+	def _worker_start(self):
+		conn, conn_worker = self._ctx.Pipe()
+		proc = self._ctx.Process( target=_worker_main, daemon=True,
+			args=(conn_worker, ( self.path, self.dir_path,
+				self.sound, self.cache_size, self.parse_cache_dir )) )
+		proc.start()
+		conn_worker.close()
+		w = FilterWorker(proc, conn)
+		w.watch = GLib.io_add_watch( conn.fileno(), GLib.PRIORITY_DEFAULT,
+			GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self._worker_result, w )
+		w.timer = self.scheduler.timer(self._task_timeout, w)
+		return w
+
+	def _worker_stop(self, w):
+		if w.watch: GLib.source_remove(w.watch)
+		self.scheduler.cancel(w.timer)
+		w.watch = w.task_id = None
+		w.proc.kill()
+		w.proc.join()
+		w.conn.close()
+
+	def _worker_replace(self, w):
+		self._worker_stop(w)
+		self._workers[self._workers.index(w)] = self._worker_start()
+
+	def check(self, summary, body, app_name, hints, callback):
+		'''Schedule filtering of the message,
+			with callback(verdict, props, error) called with the result later.
+			hints are only used to pick filter from FilterIndex, and must be picklable.'''
+		task_id = next(self._task_ids)
+		self._pending[task_id] = (summary, body, app_name, hints), callback
+		self._queue.append(task_id)
+		self._dispatch()
+
+	def _dispatch(self):
+		for w in list(self._workers):
+			if not self._queue: break
+			if w.task_id is not None: continue
+			w.task_id = self._queue.popleft()
+			try: w.conn.send(self._pending[w.task_id][0])
+			except OSError as err: # worker died
+				self._worker_fail(w, (True, None, f'Filter worker failure: {err!r}'))
+				continue
+			self.scheduler.schedule(w.timer, self.timeout)
+
+	def _task_done(self, w, res):
+		self.scheduler.cancel(w.timer)
+		task_id, w.task_id = w.task_id, None
+		args, callback = self._pending.pop(task_id)
+		callback(*res)
+
+	def _worker_fail(self, w, res):
+		'Replaces worker, with callback for its current message getting res, if any.'
+		task_id = w.task_id
+		self._worker_replace(w)
+		if task_id is None: return
+		args, callback = self._pending.pop(task_id)
+		callback(*res)
+
+	def _worker_result(self, fd, cond, w):
+		try: res = w.conn.recv() if cond & GLib.IO_IN else None
+		except (EOFError, OSError): res = None
+		if res is None:
+			log.warning('Filter worker exited unexpectedly (pid: %s)', w.proc.pid)
+			w.watch = None # removed by returning False here
+			self._worker_fail(w, (True, None, 'Filter worker failure: process exited'))
+		elif w.task_id is not None: self._task_done(w, res)
+		self._dispatch()
+		return res is not None
+
+	def _task_timeout(self, w):
+		log.warning( 'Filter worker timeout (%.1fs) for'
+			' message, fail-%s policy', self.timeout, 'open' if self.fail_open else 'closed' )
+		self._worker_fail(w, (self.fail_open, None, None)) # kills stuck worker
+		self._dispatch()
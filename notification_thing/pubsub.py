@@ -1,4 +1,4 @@
-import os, sys, re, time, functools as ft
+import os, sys, re, time, base64, functools as ft
 
 from . import core
 
@@ -6,10 +6,14 @@ from . import core
 class PubSub:
 
 	# Messages with higher versions will be discarded
-	protocol_version = 1
+	# Version 2 sends byte arrays as base64, instead of lists of byte values in version 1
+	protocol_version = 2
 
 	ctx = sub = pub = None
 
+	# Matches hostname at the start of the message, without parsing the rest of it
+	_hostname_peek = re.compile(br'^.\[\s*"((?:[^"\\]|\\.)*)"', re.DOTALL)
+
 
 	def __init__( self, hostname=None, peer_id=None,
 			buff_len=30, blocking_send=False, reconnect_max=300.0 ):
@@ -35,7 +39,12 @@ class PubSub:
 	def _init_encoding(self):
 		# Simple json should work ok here, I guess
 		import json
-		self.dumps, self.loads = json.dumps, json.loads
+		self.dumps, self.loads = json.dumps, ft.partial(json.loads, object_hook=self._decode_bytes)
+
+	@staticmethod
+	def _decode_bytes(obj):
+		if len(obj) == 1 and isinstance(b64 := obj.get('$b64'), str): return base64.b64decode(b64)
+		return obj
 
 	def _init_id(self, peer_id=None):
 		'This ID should - ideally - be persistent for the machine.'
@@ -112,11 +121,14 @@ class PubSub:
 		# Necessary because dbus types subclass pythin types,
 		#  yet don't serialize in the same way - e.g. str(dbus.Byte(1)) is '\x01'
 		#  (and not '1') - which messes up simple serializers like "json" module.
+		# Byte arrays ("ay", received as bytes with byte_arrays=True) are sent
+		#  as {"$b64": ...} objects, same as in StateCheckpoint, and decoded to bytes.
 		sdt = self.strip_dbus_types
 		if isinstance(data, dict): return dict((sdt(k), sdt(v)) for k,v in data.items())
 		elif isinstance(data, (list, tuple)): return list(map(sdt, data))
+		elif isinstance(data, (bytes, bytearray)): return {'$b64': base64.b64encode(data).decode()}
 		elif data is None: return data
-		for t in int, str, bytes, bool, float:
+		for t in int, str, bool, float:
 			if isinstance(data, t): return t(data)
 		raise ValueError( 'Failed to sanitize data type:'
 			f' {type(data)} (mro: {type(data).mro()}, value: {data})' )
@@ -125,10 +137,22 @@ class PubSub:
 		data = self.strip_dbus_types(note.data)
 		return chr(self.protocol_version) + self.dumps([self.hostname, time.time(), data])
 
+	def peek_hostname(self, msg):
+		'''Returns hostname from raw message, without decoding all of it,
+			or None if message does not start with one (e.g. malformed).'''
+		if not (m := self._hostname_peek.search(msg)): return
+		hostname = m.group(1)
+		if b'\\' not in hostname: return hostname.decode('utf-8', 'replace')
+		try: return self.loads(b'"' + hostname + b'"')
+		except ValueError: return
+
 	def decode(self, msg):
 		msg = msg.decode()
 		if ord(msg[0]) > self.protocol_version: return
 		hostname, ts, note_data = self.loads(msg[1:])
+		for k in core.image_data_hints:
+			if not isinstance(image := (note_data.get('hints') or dict()).get(k), list) or not image: continue
+			if isinstance(image[-1], list): image[-1] = bytes(image[-1]) # protocol version 1
 		return core.NotificationMessage(hostname, ts, core.Notification(**note_data))
 
 	def send(self, note):
@@ -140,15 +164,20 @@ class PubSub:
 		except self.zmq.ZMQError as err:
 			if err.errno != self.zmq.EAGAIN: raise
 
-	def recv(self, raw=False):
+	def recv(self, raw=False, admit=None):
 		'''Receive message from any of the connected
-			peers, if available, otherwise None is returned.'''
+				peers, if available, otherwise None is returned.
+			admit(hostname) function can be passed to discard messages from some hosts
+				early, returning False for these, so they won't be decoded (and skipped).'''
 		msg = None
 		while not msg:
 			try: msg = self.sub.recv(self.zmq.DONTWAIT)
 			except self.zmq.ZMQError as err:
 				if err.errno != self.zmq.EAGAIN: raise
 				return
+			if admit and not admit(self.peek_hostname(msg)):
+				msg = None
+				continue
 			msg_res = self.decode(msg) # can be None on protocol mismatch
 		if msg_res is not None and raw: msg_res = msg
 		return msg_res
@@ -1,4 +1,4 @@
-import time, collections as cs
+import time, heapq, math, abc, itertools as it, collections as cs
 
 
 class RRQ(cs.deque): # round-robin queue
@@ -23,6 +23,54 @@ class RRQ(cs.deque): # round-robin queue
 	is_full = property(lambda s: len(self) == self._limit)
 
 
+class PRQ: # priority round-robin queue
+	'''Bounded queue, which drops lowest-priority items on overflow, in O(log n) time.
+		Priority is determined by key(item) values, with oldest item dropped among equal ones.
+		Iteration returns items in the same order in which they were added.
+		Drop counts are kept for each label(item) value in "dropped_by" dict.
+		If dedup function is specified, items for which it returns same
+			non-None value are not added, and append() returns queued item instead.
+		spill(item) function can be used to store dropped items elsewhere,
+			returning True if it did that, so that item won't be counted as dropped.'''
+
+	def __init__(self, limit, key, label=None, dedup=None, spill=None):
+		self._limit, self._key, self._label = limit, key, label
+		self._dedup, self._spill = dedup, spill
+		self._items, self._heap, self._seq = dict(), list(), it.count()
+		self._dedup_seq, self.dropped_by = dict(), cs.Counter()
+
+	def __len__(self): return len(self._items)
+	def __iter__(self): return iter(self._items.values())
+
+	dropped = property(lambda s: sum(s.dropped_by.values()))
+	is_full = property(lambda s: len(s) == s._limit)
+
+	def append(self, item):
+		dedup = self._dedup and self._dedup(item)
+		if dedup is not None:
+			if dedup in self._dedup_seq: return self._items[self._dedup_seq[dedup]]
+		seq = next(self._seq)
+		self._items[seq] = item
+		if dedup is not None: self._dedup_seq[dedup] = seq
+		heapq.heappush(self._heap, (self._key(item), seq))
+		while len(self._items) > self._limit:
+			prio, seq = heapq.heappop(self._heap)
+			item = self._items.pop(seq)
+			dedup = self._dedup and self._dedup(item)
+			if dedup is not None and self._dedup_seq.get(dedup) == seq: del self._dedup_seq[dedup]
+			if self._spill and self._spill(item): continue
+			self.dropped_by[self._label(item) if self._label else None] += 1
+
+	def extend(self, items):
+		for item in items: self.append(item)
+
+	def flush(self):
+		self._items.clear()
+		self._heap.clear()
+		self._dedup_seq.clear()
+		self.dropped_by.clear()
+
+
 FC_UNDEF = 0
 FC_OK = 1
 FC_EMPTY = 2
@@ -49,7 +97,7 @@ class FC_TokenBucket:
 	_spree = FC_UNDEF
 
 	def __init__( self, flow=1, burst=5, tick=1,
-			tick_strangle=None, tick_free=None, start=None ):
+			tick_strangle=None, tick_free=None, start=None, clock=time.monotonic ):
 		'''flow: how many tokens are added per tick;
 			burst: bucket size;
 			tick (seconds): time unit of operation;
@@ -59,14 +107,17 @@ class FC_TokenBucket:
 				current flow multiplier as a single argument;
 			start:
 				starting bucket size, either int/float or a function
-				of bucket capacity.'''
+				of bucket capacity;
+			clock: function returning current monotonic time in seconds,
+				can be replaced by virtual clock, e.g. for simulations.'''
 		self.fill_rate = flow
 		self.capacity = burst
 		self._tokens = burst if start is None else self._mod(start, burst)
 		self._tick = tick
 		self._tick_strangle = tick_strangle
 		self._tick_free = tick_free
-		self._synctime = time.monotonic()
+		self._clock = clock
+		self._synctime = clock()
 
 	_mod = lambda s, method, val: \
 		method if isinstance(method, (int, float)) else method(s._tick_mul)
@@ -96,7 +147,7 @@ class FC_TokenBucket:
 	@property
 	def tokens(self):
 		'Number of tokens in the bucket at the moment'
-		ts = time.monotonic()
+		ts = self._clock()
 		if self._tokens < self.capacity:
 			self._tokens = min( self.capacity,
 				self._tokens + self.fill_rate * (ts - self._synctime) / self.tick )
@@ -109,7 +160,7 @@ class FC_TokenBucket:
 			## TODO: Implement buffered grab for this case?
 			raise ValueError( 'Token bucket deadlock:'
 				f' {count} tokens requested, while max capacity is {self.capacity}' )
-		return self.tick - time.monotonic() % self.tick
+		return self.tick - self._clock() % self.tick
 
 	def consume(self, count=1, block=False, force=False):
 		'Take tokens from the bucket'
@@ -133,3 +184,172 @@ class FC_TokenBucket:
 		'Check token availability w/o taking any'
 		if count <= self.tokens: return True
 		else: return False
+
+
+class FC_Policy(abc.ABC):
+	'''Interface for flow control policies, with exact next-allowed times.
+		Same as FC_TokenBucket, "count" tokens are taken on each consume() call,
+			which returns False if these are not available, unless force=True is used.
+		get_eta() returns exact number of seconds until specified number of tokens
+			becomes available (zero if they are available now), and poll() checks that.'''
+
+	def __init__(self, burst=5, tick=1, clock=time.monotonic):
+		if burst < 1: raise ValueError(f'Burst value must be >=1: {burst}')
+		self.capacity, self._tick, self._clock = burst, tick, clock
+
+	tick = property(lambda s: float(s._tick))
+
+	@abc.abstractmethod
+	def get_eta(self, count=1): pass
+	@abc.abstractmethod
+	def consume(self, count=1, force=False): pass
+
+	def poll(self, count=1): return self.get_eta(count) <= 0
+
+	def _check_count(self, count):
+		if count > self.capacity:
+			raise ValueError( 'Flow control deadlock:'
+				f' {count} tokens requested, while max capacity is {self.capacity}' )
+
+
+class FC_GCRA(FC_Policy):
+	'''Generic Cell Rate Algorithm - equivalent of token bucket of "burst" size,
+			refilled by one token every "tick" seconds, but with state being just
+			one "theoretical arrival time" (tat) value for the next token.
+		Does not have adaptive strangle/free rate adjustments of FC_TokenBucket.'''
+
+	def __init__(self, burst=5, tick=1, clock=time.monotonic):
+		super().__init__(burst, tick, clock)
+		self._tat = clock()
+
+	@property
+	def tokens(self):
+		'Number of tokens available at the moment'
+		return self.capacity - max(0, self._tat - self._clock()) / self._tick
+
+	def get_eta(self, count=1):
+		self._check_count(count)
+		return max(0, self._tat + (count - self.capacity) * self._tick - self._clock())
+
+	def consume(self, count=1, force=False):
+		ts = self._clock()
+		if not force and self.get_eta(count) > 0: return False
+		self._tat = max(self._tat, ts) + count * self._tick
+		return True
+
+
+class FC_SlidingLog(FC_Policy):
+	'''Allows up to "burst" tokens to be taken within any
+			sliding time window of burst * tick seconds.
+		State is a log of timestamps for tokens taken within the window,
+			which can be more than "burst" of them, if force=True is used in consume().
+		Fractional burst value is rounded down, as log has one entry per token.'''
+
+	def __init__(self, burst=5, tick=1, clock=time.monotonic):
+		super().__init__(int(burst), tick, clock)
+		self.window, self._log = self.capacity * tick, cs.deque()
+
+	def _expire(self):
+		ts_min = self._clock() - self.window
+		while self._log and self._log[0] <= ts_min: self._log.popleft()
+
+	@property
+	def tokens(self):
+		'Number of tokens available at the moment'
+		self._expire()
+		return self.capacity - len(self._log)
+
+	def get_eta(self, count=1):
+		self._check_count(count)
+		self._expire()
+		n = len(self._log) + math.ceil(count) - self.capacity
+		return 0 if n <= 0 else self._log[n - 1] + self.window - self._clock()
+
+	def consume(self, count=1, force=False):
+		if not force and self.get_eta(count) > 0: return False
+		self._log.extend([self._clock()] * math.ceil(count))
+		return True
+
+
+class FC_TokenBucketTree:
+	'''Hierarchy of token buckets - global one, and per-key ones nested under it,
+			so that each message has to take tokens from both global bucket and
+			buckets for each of its keys (e.g. app_name and remote host) to pass.
+		This way busy source gets throttled by its own bucket,
+			without draining global one and delaying messages from everything else.
+
+		Keyed buckets are created on demand via bucket_factory(key) call,
+			which can return None to not have per-key limit for that key.
+		These are stored in an LRU table of up to size_max entries,
+			dropping least-recently-used (i.e. idle) buckets when it overflows.'''
+
+	def __init__(self, bucket, bucket_factory=None, size_max=1000):
+		self.bucket, self.bucket_factory = bucket, bucket_factory
+		self.size_max, self.evicted = size_max, 0
+		self.buckets = cs.OrderedDict()
+
+	def __len__(self): return len(self.buckets)
+
+	def get(self, key):
+		'Returns token bucket for key, or None if there is no limit for it.'
+		try:
+			self.buckets.move_to_end(key)
+			return self.buckets[key]
+		except KeyError: pass
+		if not self.bucket_factory or self.size_max <= 0: return None
+		bucket = self.buckets[key] = self.bucket_factory(key)
+		while len(self.buckets) > self.size_max:
+			self.buckets.popitem(last=False)
+			self.evicted += 1
+		return bucket
+
+	def _buckets(self, keys):
+		return [self.bucket] + list(filter(None, map(self.get, keys)))
+
+	def _count(self, b, count):
+		return min(count, b.capacity) # weighted costs can be larger than bucket
+
+	@property
+	def tokens(self):
+		'Number of tokens in the global bucket at the moment'
+		return self.bucket.tokens
+
+	def get_eta(self, keys=(), count=1):
+		'''Return amount of seconds until the given number
+			of tokens will be available in all buckets for keys.'''
+		return max( (b.get_eta(self._count(b, count)) for b in self._buckets(keys)
+				if not b.poll(self._count(b, count))),
+			default=self.bucket.get_eta(self._count(self.bucket, count)) )
+
+	def consume(self, keys=(), count=1, force=False, nested_only=False):
+		'''Take tokens from global bucket and ones for specified keys,
+				only if all of them have enough tokens, unless force=True is used.
+			nested_only=True skips global bucket, e.g. to charge sources for messages
+				passed as part of a batch, which global bucket is only charged for once.'''
+		buckets = self._buckets(keys)
+		if nested_only: buckets = buckets[1:]
+		empty = list( b for b in buckets
+			if not b.poll(self._count(b, count)) ) if not force else None
+		if empty: # only update shortage stats for empty buckets
+			for b in empty: b.consume(self._count(b, count))
+			return False
+		for b in buckets: b.consume(self._count(b, count), force=True)
+		return True
+
+	def poll(self, keys=(), count=1):
+		'Check token availability in all relevant buckets w/o taking any'
+		return all(b.poll(self._count(b, count)) for b in self._buckets(keys))
+
+	def levels(self):
+		'''Returns list of (key, tokens) for global (key=None) and all
+			keyed buckets, in LRU order, which can be passed to restore() later.'''
+		return [(None, self.bucket.tokens)] + list(
+			(key, b.tokens) for key, b in self.buckets.items() if b )
+
+	def restore(self, levels, elapsed=0):
+		'''Takes tokens from buckets to match levels from an earlier levels() call,
+			minus tokens that buckets would've been refilled with during elapsed seconds.'''
+		for key, tokens in levels:
+			if not (b := self.bucket if key is None else self.get(key)): continue
+			deficit = b.tokens - tokens - elapsed / b.tick
+			if deficit > 0: b.consume(min(deficit, b.capacity), force=True)
@@ -0,0 +1,138 @@
+import time, heapq, math, itertools as it
+
+from gi.repository import GLib
+
+import logging
+log = logging.getLogger(__name__)
+
+
+class Timer:
+	__slots__ = 'deadline', 'func', 'args', 'left', 'seq'
+
+	def __init__(self, func, args):
+		self.func, self.args = func, args
+		self.deadline = self.left = self.seq = None
+
+	active = property(lambda s: s.deadline is not None)
+	paused = property(lambda s: s.deadline is None and s.left is not None)
+
+	def __repr__(self):
+		return f'<Timer[{id(self):x}] {self.func!r} deadline={self.deadline}>'
+
+
+class Scheduler:
+	'''Deadline scheduler for all one-shot timers (expiry, flush, inactivity, etc),
+			driven by a single GLib timeout source, which is only re-armed
+			when earliest deadline changes, to avoid GSource churn on frequent events.
+		Timers are kept in a heap, with cancelled or postponed entries handled lazily,
+			so postponing timer (e.g. inactivity timeout on every call) is O(1).
+		Callbacks are run from GLib main loop, and their return values are ignored.'''
+
+	def __init__(self, clock=time.monotonic):
+		self.clock, self._heap, self._seq = clock, list(), it.count()
+		self._source = self._source_deadline = None
+		self._running = False
+
+	def timer(self, func, *args):
+		'Returns inactive Timer object for func(*args), to be started by schedule() call.'
+		return Timer(func, args)
+
+	def add(self, delay, func, *args):
+		'Run func(*args) after delay seconds, returning Timer object.'
+		timer = Timer(func, args)
+		self.schedule(timer, delay)
+		return timer
+
+	def schedule(self, timer, delay):
+		'(Re)Schedule timer in any state to run in delay seconds from now.'
+		deadline, timer.left = self.clock() + delay, None
+		if timer.active and timer.seq is not None and deadline >= timer.deadline:
+			timer.deadline = deadline # heap entry gets re-pushed when its old deadline is reached
+			return
+		timer.deadline = deadline
+		self._push(timer)
+		if not self._running and (
+			self._source_deadline is None or deadline < self._source_deadline ): self._arm()
+
+	def cancel(self, timer):
+		if timer: timer.deadline = timer.left = None
+
+	def pause(self, timer):
+		'Stop timer, remembering time left until its deadline, to resume() it later.'
+		if not timer.active: return
+		timer.left, timer.deadline = max(0, timer.deadline - self.clock()), None
+
+	def resume(self, timer, delay_min=0):
+		'Restart paused timer with time left on it, but not less than delay_min seconds.'
+		if timer.left is None: return
+		self.schedule(timer, max(timer.left, delay_min))
+
+	def _push(self, timer):
+		timer.seq = next(self._seq)
+		heapq.heappush(self._heap, (timer.deadline, timer.seq, timer))
+
+	def _pop_stale(self, ts=None):
+		'''Pop entries for cancelled/postponed timers from top of the heap,
+			and ones before ts for active timers, returning list of the latter.'''
+		due = list()
+		while self._heap:
+			deadline, seq, timer = self._heap[0]
+			if seq == timer.seq and timer.active:
+				if timer.deadline == deadline and (ts is None or deadline > ts): break
+				heapq.heappop(self._heap)
+				if timer.deadline != deadline: self._push(timer) # postponed
+				else:
+					timer.seq = None # not in the heap anymore
+					due.append(timer)
+			else: heapq.heappop(self._heap)
+		return due
+
+	def _arm(self):
+		'(Re)Arm GLib timeout source for the earliest active deadline.'
+		self._pop_stale()
+		if self._source: GLib.source_remove(self._source)
+		if not self._heap:
+			self._source = self._source_deadline = None
+			return
+		self._source_deadline = deadline = self._heap[0][0]
+		delay = math.ceil(max(0, deadline - self.clock()) * 1000)
+		self._source = GLib.timeout_add(delay, self._run)
+
+	def _run(self):
+		self._source = self._source_deadline = None
+		self._running = True
+		try:
+			for timer in self._pop_stale(self.clock()):
+				# Can be cancelled or re-scheduled by other callbacks
+				if not timer.active or timer.seq is not None: continue
+				timer.deadline = None
+				try: timer.func(*timer.args)
+				except Exception: log.exception('Failed to run scheduled callback: %r', timer.func)
+		finally: self._running = False
+		self._arm()
+		return False
+
+
+class VirtualScheduler(Scheduler):
+	'''Scheduler with virtual clock, which is only advanced by run_until() calls,
+		for running timer-driven logic without GLib main loop, e.g. in simulations.'''
+
+	def __init__(self, ts=0):
+		self.ts = ts
+		super().__init__(clock=lambda: self.ts)
+
+	def _arm(self): self._pop_stale()
+
+	def run_until(self, ts):
+		'Advance clock to ts, running all callbacks scheduled before that, in deadline order.'
+		while True:
+			self._pop_stale()
+			if not self._heap or self._heap[0][0] > ts: break
+			self.ts = max(self.ts, self._heap[0][0])
+			self._run()
+		self.ts = max(self.ts, ts)
+
+	@property
+	def next_deadline(self):
+		self._pop_stale()
+		return self._heap[0][0] if self._heap else None
@@ -4,14 +4,16 @@ import itertools as it, operator as op, functools as ft
 # Original (c) Peter Norvig, 2010; See http://norvig.com/lispy2.html
 
 
-global_env = macro_table = symbol_table = None
+global_env = macro_table = symbol_table = literal_hooks = None
 
 
 ################ Symbol, Procedure, classes
 
-import re, sys, io
+import os, re, sys, io, time, hashlib, pickle, tempfile
 
-class Symbol(str): pass
+class Symbol(str):
+	# Re-interned on unpickling, as symbols are compared by identity
+	def __reduce__(self): return Sym, (str(self),)
 
 def Sym(s):
 	'Find or create unique Symbol entry for str s in symbol table.'
@@ -25,6 +27,32 @@ class Procedure:
 	def __call__(self, *args):
 		return eval(self.exp, Env(self.parms, args, self.env))
 
+class CompiledProcedure:
+	'''A user-defined Scheme procedure, with body compiled into python closure.
+		Closure is called with a frame list of [outer_frame, arg1, ..., local1, ...],
+			where all variables are addressed by compile() as (depth, slot) pairs.
+		Body can return TailCall for calls in tail position, which are run
+			in a loop here, so that tail recursion does not grow python stack.'''
+	__slots__ = 'parms', 'nargs', 'pad', 'exp', 'frame'
+	def __init__(self, parms, nlocals, exp, frame):
+		self.parms, self.exp, self.frame = parms, exp, frame
+		self.nargs = None if isa(parms, Symbol) else len(parms)
+		self.pad = (None,) * nlocals
+	def make_frame(self, args):
+		if self.nargs is None: return [self.frame, list(args), *self.pad]
+		if len(args) != self.nargs:
+			raise TypeError(f'expected {to_string(self.parms)}, given {to_string(list(args))}')
+		return [self.frame, *args, *self.pad]
+	def __call__(self, *args):
+		res = self.exp(self.make_frame(args))
+		while isa(res, TailCall): res = res.proc.exp(res.proc.make_frame(res.args))
+		return res
+
+class TailCall:
+	'CompiledProcedure call in tail position, returned instead of running it.'
+	__slots__ = 'proc', 'args'
+	def __init__(self, proc, args): self.proc, self.args = proc, args
+
 isa = isinstance
 
 
@@ -39,22 +67,28 @@ def parse(inport):
 eof_object = Symbol('#<eof-object>') # Note: uninterned; can't be read
 
 class InPort:
-	'An input port. Retains a line of chars.'
-	tokenizer = r"""\s*(,@|[('`,)]|"(?:[\\].|[^\\"])*"|;.*|[^\s('"`,;)]*)(.*)"""
+	'''An input port. Retains a line of chars and position in it.
+		Tokens are matched at an offset, without slicing the line, so it's linear-time.'''
+	tokenizer = re.compile(r"""\s*(,@|[('`,)]|"(?:[\\].|[^\\"])*"|;.*|[^\s('"`,;)]*)""")
 	def __init__(self, file):
-		self.file = file; self.line = ''
+		self.file = file; self.line, self.pos = '', 0
 	def next_token(self):
 		'Return the next token, reading new text into line buffer if needed.'
 		while True:
-			if self.line == '': self.line = self.file.readline()
-			if self.line == '': return eof_object
-			token, self.line = re.match(InPort.tokenizer, self.line).groups()
-			if token != '' and not token.startswith(';'): return token
+			if self.pos >= len(self.line):
+				self.line, self.pos = self.file.readline(), 0
+				if self.line == '': return eof_object
+			m = self.tokenizer.match(self.line, self.pos)
+			token, self.pos = m.group(1), m.end()
+			if token == '':
+				if self.pos < len(self.line): # e.g. unterminated string
+					raise SyntaxError(f'unexpected input: {self.line[self.pos:].strip()!r}')
+			elif token[0] != ';': return token
 
 def readchar(inport):
 	'Read the next character from an input port.'
-	if inport.line != '':
-		ch, inport.line = inport.line[0], inport.line[1:]
+	if inport.pos < len(inport.line):
+		ch, inport.pos = inport.line[inport.pos], inport.pos + 1
 		return ch
 	else:
 		return inport.file.read(1) or eof_object
@@ -94,23 +128,96 @@ def to_string(x):
 	if x is True: return "#t"
 	elif x is False: return "#f"
 	elif isa(x, Symbol): return x
-	elif isa(x, str): return '"{}"'.format(x.encode('string_escape').replace('"',r'\"'))
+	elif isa(x, str): return f'"{x}"' # reader does not process escapes in these
 	elif isa(x, list): return '('+' '.join(map(to_string, x))+')'
 	elif isa(x, complex): return str(x).replace('j', 'i')
 	else: return str(x)
 
-def load(filename):
-	'Eval every expression from a file.'
-	return repl(InPort(open(filename)), out=None)
+def load( filename, compiled=True,
+		refs=None, sets=None, profile=None, cache_dir=None, env=None ):
+	'''Eval every expression from a file.
+		If refs set is passed, all symbols used in expanded code are added to it.
+		If sets set is passed, non-local variables assigned in procedures
+			are added to it, i.e. ones that can keep state between calls (see set_nonlocals).
+		Profile object can be passed to collect stats from compiled code.
+		cache_dir enables caching expanded code there (see FormCache), to skip parsing.
+		env can be used to define top-level names in, instead of global_env,
+			e.g. Env(outer=global_env) to have separate namespace for each loaded file.
+		Macros defined in the file are evaluated in env, and only used in that file.'''
+	with open(filename) as src: code = src.read()
+	cache, macros = cache_dir and FormCache(cache_dir, filename, code), macro_table.copy()
+	forms = cache and cache.load(macros, env)
+	if forms is None: forms = read_forms(InPort(io.StringIO(code)), cache, macros, env)
+	compiled, val = compiled or profile is not None, None
+	for n, x in enumerate(forms, 1):
+		if refs is not None: refs.update(symbols(x))
+		if sets is not None: sets.update(set_nonlocals(x))
+		if not compiled: val = eval(x, env)
+		else:
+			prof = profile is not None and (profile, f'form-{n} {profile.label(x)}')
+			val = compile(x, profile=prof or None, genv=env)(None)
+	return val
+
+def read_forms(inport, cache=None, macros=None, env=None):
+	'''Generator for expanded forms from inport, saving these to FormCache at the end.
+		Must be evaluated in-between, as macros get defined and used in the process.
+		macros and env are passed to expand(), see its docstring for these.'''
+	if macros is None: macros = macro_table
+	records = list()
+	while True:
+		x = read(inport)
+		if x is eof_object: break
+		macros_chk = macros.copy()
+		x_exp = expand(x, toplevel=True, macros=macros, env=env)
+		# Forms that (re)define macros are cached as-is, to run these on load
+		records.append((True, x) if macros != macros_chk else (False, x_exp))
+		yield x_exp
+	if cache: cache.save(records)
+
+class FormCache:
+	'''Cache of expanded top-level forms from the file in cache_dir, keyed by
+			content hash and cache_version, one cache file per source file path.
+		Forms that define macros are stored unexpanded, and re-expanded on load.
+		Errors on saving are ignored, as it's only used to speed up loading,
+			and such files will just be parsed without cache every time.'''
+
+	cache_version = 2 # should be bumped on any changes to reader/expand
+
+	def __init__(self, cache_dir, filename, code):
+		self.key = self.cache_version, hashlib.sha256(code.encode()).hexdigest()
+		self.path = os.path.join( cache_dir, 'filter-{}.pickle'.format(
+			hashlib.sha256(os.path.abspath(filename).encode()).hexdigest()[:16] ) )
+
+	def load(self, macros=None, env=None):
+		try:
+			with open(self.path, 'rb') as src: key, records = pickle.load(src)
+		except Exception: return
+		if key != self.key: return
+		return ( (expand(x, toplevel=True, macros=macros, env=env)
+			if raw else x) for raw, x in records )
 
-def repl(inport=InPort(sys.stdin), out=sys.stdout):
+	def save(self, records):
+		try:
+			os.makedirs(os.path.dirname(self.path), 0o700, exist_ok=True)
+			with tempfile.NamedTemporaryFile( 'wb',
+					dir=os.path.dirname(self.path), delete=False ) as tmp:
+				try:
+					pickle.dump((self.key, records), tmp)
+					tmp.flush()
+					os.rename(tmp.name, self.path)
+				finally:
+					if os.path.exists(tmp.name): os.unlink(tmp.name)
+		# AttributeError/TypeError can be raised by pickle for unpicklable objects in forms
+		except (OSError, pickle.PicklingError, AttributeError, TypeError): pass
+
+def repl(inport=InPort(sys.stdin), out=sys.stdout, compiled=False):
 	'A prompt-read-eval-print loop.'
 	val = None
 	while True:
 		try:
 			x = parse(inport)
 			if x is eof_object: return val
-			val = eval(x)
+			val = eval(x) if not compiled else compile(x)(None)
 			if out and val is not None: print(to_string(val), file=out)
 		except Exception as e:
 			if out: print(f'{e.__class__.__name__}: {e}', file=out)
@@ -216,10 +323,221 @@ def eval(x, env=None):
 					raise
 
 
+################ compile (into python closures)
+
+def compile(x, scopes=(), profile=None, genv=None, tail=False):
+	'''Compile expanded expression into a python closure, which takes frame list
+			(see CompiledProcedure) or None for top-level code as an argument.
+		Result of calling it is same as eval(x, genv), but without re-dispatching
+			on expression type for every node on every call, and with variables
+			in lambdas resolved to fixed (depth, slot) addresses in nested frames.
+		"scopes" is a tuple of variable name lists for enclosing lambdas, innermost first.
+		"genv" is Env to use for globals, not bound in any lambdas, global_env by default.
+		"profile" is an optional (Profile, key) tuple, where key is used
+			for stats of outermost lambdas, and set to None for nested ones.
+		"tail" is set for expressions in tail position of lambda bodies, where calls
+			to CompiledProcedure return TailCall for it to run, same as eval() loop does.
+		Only non-tail calls are limited by python stack depth, same as with eval().'''
+	if genv is None: genv = global_env
+	comp = lambda x, tail=False: compile(x, scopes, profile, genv, tail)
+	if isa(x, Symbol): # variable reference
+		return compile_ref(x, scopes, genv)
+	elif not isa(x, list): # constant literal
+		return lambda frame: x
+	elif x[0] is _quote: # (quote exp)
+		(_, exp) = x
+		return lambda frame: exp
+	elif x[0] is _if: # (if test conseq alt)
+		test, conseq, alt = comp(x[1]), comp(x[2], tail), comp(x[3], tail)
+		return lambda frame: conseq(frame) if test(frame) else alt(frame)
+	elif x[0] is _set or x[0] is _define: # (set var exp), (define var exp)
+		(_, var, exp), exp = x, comp(x[2])
+		depth, slot, define = *resolve(var, scopes), x[0] is _define
+		if depth is None:
+			def _set_global(frame):
+				val = exp(frame)
+				if not define: genv.find(var)[var] = val
+				else:
+					genv[var] = val
+					return val
+			return _set_global
+		def _set_local(frame):
+			val, dst = exp(frame), frame
+			for n in range(depth): dst = dst[0]
+			dst[slot] = val
+			if define: return val
+		return _set_local
+	elif x[0] is _lambda: # (lambda (var*) exp)
+		(_, vars, exp) = x
+		names = [vars] if isa(vars, Symbol) else list(vars)
+		local = sorted(local_defs(exp).difference(names))
+		scopes = (names + local,) + scopes
+		if not profile or not profile[1]: exp = compile(exp, scopes, profile, genv, True)
+		else:
+			exp = profile[0].wrap( profile[1],
+				compile(exp, scopes, (profile[0], None), genv, True) )
+		nlocals = len(local)
+		return lambda frame: CompiledProcedure(vars, nlocals, exp, frame)
+	elif x[0] is _begin: # (begin exp+)
+		exps, exp_last = list(map(comp, x[1:-1])), comp(x[-1], tail)
+		def _begin_seq(frame):
+			for exp in exps: exp(frame)
+			return exp_last(frame)
+		return _begin_seq
+	else: # (proc exp*)
+		args, sym = x[1:], isa(x[0], Symbol) and resolve(x[0], scopes)[0] is None and x[0]
+		if sym in literal_hooks:
+			func, hook = literal_hooks[sym]
+			try: sym_global = genv.find(sym)[sym]
+			except LookupError: sym_global = None
+			if sym_global is func: args = hook(args)
+		profiled = profile and sym in profile[0].calls # stats need result of the call
+		call = (compile_call if not tail or profiled else compile_tail_call)(
+			comp(x[0]), list(map(comp, args)) )
+		if profiled: call = profile[0].wrap(profile[0].label(x), call)
+		return call
+
+def resolve(var, scopes):
+	'Returns (depth, slot) address of lexically-bound var, or (None, None) for globals.'
+	for depth, names in enumerate(scopes):
+		try: return depth, names.index(var) + 1 # slot 0 is outer frame
+		except ValueError: pass
+	return None, None
+
+def compile_ref(x, scopes, genv):
+	'Returns closure for variable reference, with fixed-depth ones for common cases.'
+	depth, slot = resolve(x, scopes)
+	if depth is None:
+		def _global_ref(frame):
+			try: return genv[x]
+			except KeyError: return genv.find(x)[x]
+		return _global_ref
+	elif depth == 0: return lambda frame: frame[slot]
+	elif depth == 1: return lambda frame: frame[0][slot]
+	elif depth == 2: return lambda frame: frame[0][0][slot]
+	def _ref(frame):
+		for n in range(depth): frame = frame[0]
+		return frame[slot]
+	return _ref
+
+def compile_call(proc, args):
+	'Returns closure for procedure call, with fixed-arity ones for common cases.'
+	if not args: return lambda frame: proc(frame)()
+	elif len(args) == 1:
+		(a,) = args
+		return lambda frame: proc(frame)(a(frame))
+	elif len(args) == 2:
+		a, b = args
+		return lambda frame: proc(frame)(a(frame), b(frame))
+	elif len(args) == 3:
+		a, b, c = args
+		return lambda frame: proc(frame)(a(frame), b(frame), c(frame))
+	return lambda frame: proc(frame)(*(a(frame) for a in args))
+
+def compile_tail_call(proc, args):
+	'Returns closure for procedure call in tail position, see TailCall.'
+	if len(args) == 1:
+		(a,) = args
+		def _tail_call(frame):
+			func = proc(frame)
+			if type(func) is not CompiledProcedure: return func(a(frame))
+			return TailCall(func, (a(frame),))
+	elif len(args) == 2:
+		a, b = args
+		def _tail_call(frame):
+			func = proc(frame)
+			if type(func) is not CompiledProcedure: return func(a(frame), b(frame))
+			return TailCall(func, (a(frame), b(frame)))
+	else:
+		def _tail_call(frame):
+			func, vals = proc(frame), tuple(a(frame) for a in args)
+			if type(func) is not CompiledProcedure: return func(*vals)
+			return TailCall(func, vals)
+	return _tail_call
+
+class Profile(dict):
+	'''Stats for parts of the compiled code, as {(site, label): [calls, truthy_results, seconds]}.
+		Tracks calls to procedures defined by top-level forms
+			and calls to specified builtins, with each call site counted separately,
+			using unique "site" number in the key, as label text can be same for many.
+		key_str() can be used to format these keys for display, with both site and label.
+		Time is inclusive of nested calls, but not counted twice for recursive ones.
+		Procedure calls from tail position (see TailCall) run after the caller returns,
+			so are not included in its time, and its result is only counted if it's not one.'''
+
+	def __init__(self, calls=('~', '~match'), label_len=70):
+		self.calls, self.label_len, self._sites = set(calls), label_len, it.count(1)
+		super().__init__()
+
+	@staticmethod
+	def key_str(key): return '#{} {}'.format(*key)
+
+	def label(self, x):
+		label = to_string(x)
+		if len(label) > self.label_len: label = label[:self.label_len-3] + '...'
+		return label
+
+	def wrap(self, label, func):
+		stats, depth = self.setdefault((next(self._sites), label), [0, 0, 0.0]), [0]
+		def _profiled(frame):
+			res, ts = None, time.perf_counter()
+			depth[0] += 1
+			try:
+				res = func(frame)
+				return res
+			finally:
+				depth[0] -= 1
+				stats[0] += 1
+				if res and not isa(res, TailCall): stats[1] += 1
+				if not depth[0]: stats[2] += time.perf_counter() - ts
+		return _profiled
+
+	def report(self):
+		'Returns list of lines with formatted stats, sorted by time spent.'
+		lines = list()
+		for k, (calls, matches, td) in sorted(self.items(), key=lambda kv: -kv[1][2]):
+			lines.append( f'{td*1e3:10.3f}ms {calls:>8d} calls'
+				f' {matches:>8d} true ({matches / (calls or 1):4.0%}) :: {self.key_str(k)}' )
+		return lines
+
+def local_defs(x):
+	'Return set of names defined by expanded expression x, not counting nested lambdas.'
+	if not is_pair(x) or x[0] is _quote or x[0] is _lambda: return set()
+	names = set([x[1]]) if x[0] is _define else set()
+	return names.union(*map(local_defs, x))
+
+def set_nonlocals(x, names=None):
+	'''Return set of variables assigned via (set var exp) inside lambdas in expanded
+			expression x, where var is not an argument or local define of innermost lambda.
+		These are globals or closure variables, changing which keeps state between calls.
+		Note that (define ...) in lambdas always creates local variables.'''
+	if not is_pair(x) or x[0] is _quote: return set()
+	if x[0] is _lambda:
+		(_, vars, exp) = x
+		names = set([vars] if isa(vars, Symbol) else vars).union(local_defs(exp))
+		return set_nonlocals(exp, names)
+	found = {x[1]} if x[0] is _set and names is not None and x[1] not in names else set()
+	return found.union(*(set_nonlocals(v, names) for v in x))
+
+def symbols(x):
+	'Return set of all symbols in expression x, including quoted ones.'
+	if isa(x, Symbol): return {x}
+	elif not isa(x, list): return set()
+	return set().union(*map(symbols, x))
+
+def is_literal_str(x):
+	'Check if expanded expression is a string literal, as opposed to a Symbol.'
+	return isa(x, str) and not isa(x, Symbol)
+
+
 ################ expand
 
-def expand(x, toplevel=False):
-	'Walk tree of x, making optimizations/fixes, and signaling SyntaxError.'
+def expand(x, toplevel=False, macros=None, env=None):
+	'''Walk tree of x, making optimizations/fixes, and signaling SyntaxError.
+		macros is a dict of macros to use and add new ones to, macro_table by default,
+			and env is Env to evaluate (define-macro ...) procedures in, global_env by default.'''
+	if macros is None: macros = macro_table
+	expand_ = lambda x, toplevel=False: expand(x, toplevel, macros, env)
 	require(x, x!=[]) # () => Error
 	if not isa(x, list): # constant => unchanged
 		return x
@@ -229,46 +547,46 @@ def expand(x, toplevel=False):
 	elif x[0] is _if:
 		if len(x)==3: x = x + [None] # (if t c) => (if t c None)
 		require(x, len(x)==4)
-		return list(map(expand, x))
+		return list(map(expand_, x))
 	elif x[0] is _set:
 		require(x, len(x)==3);
 		var = x[1] # (set non-var exp) => Error
 		require(x, isa(var, Symbol), 'can set only a symbol')
-		return [_set, var, expand(x[2])]
+		return [_set, var, expand_(x[2])]
 	elif x[0] is _define or x[0] is _definemacro:
 		require(x, len(x)>=3)
 		_def, v, body = x[0], x[1], x[2:]
 		if isa(v, list) and v: # (define (f args) body)
 			f, args = v[0], v[1:] # => (define f (lambda (args) body))
-			return expand([_def, f, [_lambda, args]+body])
+			return expand_([_def, f, [_lambda, args]+body], toplevel)
 		else:
 			require(x, len(x)==3) # (define non-var/list exp) => Error
 			require(x, isa(v, Symbol), 'can define only a symbol')
-			exp = expand(x[2])
+			exp = expand_(x[2])
 			if _def is _definemacro:
 				require(x, toplevel, 'define-macro only allowed at top level')
-				proc = eval(exp)
+				proc = eval(exp, env)
 				require(x, callable(proc), 'macro must be a procedure')
-				macro_table[v] = proc # (define-macro v proc)
-				return None # => None; add v:proc to macro_table
+				macros[v] = proc # (define-macro v proc)
+				return None # => None; add v:proc to macros
 			return [_define, v, exp]
 	elif x[0] is _begin:
 		if len(x)==1: return None # (begin) => None
-		else: return [expand(xi, toplevel) for xi in x]
+		else: return [expand_(xi, toplevel) for xi in x]
 	elif x[0] is _lambda: # (lambda (x) e1 e2)
 		require(x, len(x)>=3) # => (lambda (x) (begin e1 e2))
 		vars, body = x[1], x[2:]
 		require(x, (isa(vars, list) and all(isa(v, Symbol) for v in vars))
 				or isa(vars, Symbol), 'illegal lambda argument list')
 		exp = body[0] if len(body) == 1 else [_begin] + body
-		return [_lambda, vars, expand(exp)]
+		return [_lambda, vars, expand_(exp)]
 	elif x[0] is _quasiquote: # `x => expand_quasiquote(x)
 		require(x, len(x)==2)
 		return expand_quasiquote(x[1])
-	elif isa(x[0], Symbol) and x[0] in macro_table:
-		return expand(macro_table[x[0]](*x[1:]), toplevel) # (m arg...)
+	elif isa(x[0], Symbol) and x[0] in macros:
+		return expand_(macros[x[0]](*x[1:]), toplevel) # (m arg...)
 	else: # => macroexpand if m isa macro
-		return list(map(expand, x)) # (f arg...) => expand each
+		return list(map(expand_, x)) # (f arg...) => expand each
 
 def require(x, predicate, msg='wrong length'):
 	'Signal a syntax error if predicate is false.'
@@ -300,10 +618,30 @@ def let(*args):
 	return [[_lambda, list(vars)]+list(map(expand, body))] + list(map(expand, vals))
 
 
+# and/or macros are defined here instead of parsing these from scheme code on every init
+
+def macro_and(*args):
+	'''(and) => #t; (and x) => x; (and x y...) => (if x (and y...) #f)'''
+	if not args: return True
+	if len(args) == 1: return args[0]
+	return [_if, args[0], [_and, *args[1:]], False]
+
+def macro_or(*args):
+	'''(or) => #f; (or x) => x; (or x y...) => (if x x (or y...))'''
+	if not args: return False
+	if len(args) == 1: return args[0]
+	return [_if, args[0], args[0], [_or, *args[1:]]]
+
+
 ## Interpreter setup
 
-def init_env(env_ext=dict()):
-	global global_env, macro_table, symbol_table
+def init_env(env_ext=dict(), literal_hooks_ext=dict()):
+	'''Init global interpreter state, adding env_ext values to global env.
+		literal_hooks_ext is a {name: hook} mapping of functions to run on the list
+			of argument expressions for calls to env_ext procedures on compile stage,
+			e.g. to pre-process string literals there, and return new list of args.
+		These are only used while same procedure is still bound to that global name.'''
+	global global_env, macro_table, symbol_table, literal_hooks
 	symbol_table = dict()
 
 	global_env = add_globals(Env())
@@ -317,17 +655,11 @@ def init_env(env_ext=dict()):
 	_append, _cons, _let = map(Sym, ['append', 'cons', 'let'])
 	quotes = {"'":_quote, '`':_quasiquote, ',':_unquote, ',@':_unquotesplicing}
 
-	macro_table = {_let:let}
+	global _and, _or
+	_and, _or = map(Sym, ['and', 'or'])
 
-	peval('''(begin
-	(define-macro and (lambda args
-		(if (null? args) #t
-			(if (= (length args) 1) (car args)
-				`(if ,(car args) (and ,@(cdr args)) #f)))))
-	(define-macro or (lambda args
-		(if (null? args) #f
-			(if (= (length args) 1) (car args)
-				`(if ,(car args) ,(car args) (or ,@(cdr args)))))))
-	)''')
+	macro_table = {_let:let, _and:macro_and, _or:macro_or}
 
 	for sym,val in env_ext.items(): global_env[Sym(sym)] = val
+	literal_hooks = dict( (Sym(sym), (env_ext[sym], hook))
+		for sym, hook in literal_hooks_ext.items() )
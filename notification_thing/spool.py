@@ -0,0 +1,92 @@
+import os, struct, logging
+
+log = logging.getLogger(__name__)
+
+
+class SpoolError(Exception): pass
+
+class NotificationSpool:
+	'''Append-only file segment for notifications that did not fit into
+			in-memory buffer, to be read back in pages when it's flushed.
+		Only summary/body text (as displayed in feeds), app_name, urgency
+			and wall-clock timestamp are stored, in a compact binary format:
+			file header with read offset, then records of fixed-size header + utf-8 strings.
+		File gets truncated after all records are read from it,
+			and is re-used on daemon restart, dropping any partially-written record.'''
+
+	magic = b'NTS1'
+	file_hdr = struct.Struct('<4sQ') # magic, read offset
+	rec_hdr = struct.Struct('<dbHII') # ts, urgency, len(app_name), len(summary), len(body)
+
+	def __init__(self, path):
+		self.path, self.count, self._read_pos = path, 0, self.file_hdr.size
+		if dst_dir := os.path.dirname(path): os.makedirs(dst_dir, 0o700, exist_ok=True)
+		self._file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+		hdr = self._file.read(self.file_hdr.size)
+		magic, pos = self.file_hdr.unpack(hdr) if len(hdr) == self.file_hdr.size else (hdr, 0)
+		if magic != self.magic:
+			if magic: log.warning('Discarding unrecognized spool file contents: %r', path)
+			self._truncate()
+		else: self._recover(max(pos, self.file_hdr.size))
+
+	def __len__(self): return self.count
+
+	def _write_hdr(self):
+		self._file.seek(0)
+		self._file.write(self.file_hdr.pack(self.magic, self._read_pos))
+		self._file.flush()
+
+	def _truncate(self):
+		self._file.truncate(0)
+		self.count, self._read_pos = 0, self.file_hdr.size
+		self._write_hdr()
+
+	def _recover(self, pos):
+		'Count records left from previous run, dropping incomplete one at the end.'
+		self._read_pos = pos
+		while True:
+			self._file.seek(pos)
+			if not self._read_record(): break
+			pos, self.count = self._file.tell(), self.count + 1
+		self._file.truncate(pos)
+		if self.count: log.debug('Found %s notification(s) in spool: %r', self.count, self.path)
+
+	def _read_record(self):
+		hdr = self._file.read(self.rec_hdr.size)
+		if len(hdr) != self.rec_hdr.size: return
+		ts, urgency, *lens = self.rec_hdr.unpack(hdr)
+		data = self._file.read(sum(lens))
+		if len(data) != sum(lens): return
+		app_name, summary, body, n = list(), list(), list(), 0
+		for res, k in zip([app_name, summary, body], lens):
+			res.append(data[n:n+k].decode('utf-8', 'replace'))
+			n += k
+		return ts, (urgency if urgency >= 0 else None), app_name[0], summary[0], body[0]
+
+	def append(self, ts, urgency, app_name, summary, body):
+		fields = list(s.encode('utf-8', 'backslashreplace') for s in [app_name, summary, body])
+		fields[0] = fields[0][:0xffff] # app_name length is uint16, decoded with errors=replace
+		try: hdr = self.rec_hdr.pack(ts, -1 if urgency is None else urgency, *map(len, fields))
+		except struct.error as err: # e.g. urgency out of int8 range, or >4G summary/body
+			raise SpoolError(f'Failed to encode spool record: {err}') from err
+		try:
+			self._file.seek(0, os.SEEK_END)
+			self._file.write(b''.join([hdr, *fields]))
+			self._file.flush()
+		except OSError as err: raise SpoolError(f'Failed to write to spool file: {err}') from err
+		self.count += 1
+
+	def read(self, count):
+		'''Returns list of up to count oldest (ts, urgency, app_name, summary, body)
+			tuples, removing these from the spool, truncating it when it becomes empty.'''
+		recs = list()
+		self._file.seek(self._read_pos)
+		while len(recs) < count and (rec := self._read_record()):
+			recs.append(rec)
+		self._read_pos, self.count = self._file.tell(), self.count - len(recs)
+		if not self.count or not recs: self._truncate()
+		else: self._write_hdr()
+		return recs
+
+	def close(self):
+		self._file.close()